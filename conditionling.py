@@ -6,62 +6,135 @@
 
 import os
 import operator
-from textx.metamodel import metamodel_from_file
+import functools
+import threading
 
 file = "conditionling.tx"
 path = os.path.dirname(os.path.realpath(__file__))
-conditionling_metamodel = metamodel_from_file(os.path.join(path, file))
 
-def evaluate_conditions(dsl_string, environment):
-    conditions = conditionling_metamodel.model_from_str(dsl_string)
+operator_lookup = {
+    "<" : operator.lt,
+    "<=" : operator.le,
+    "=" : operator.eq,
+    "==" : operator.eq,
+    "!=" : operator.ne,
+    ">=" : operator.ge,
+    ">" : operator.gt
+}
 
-    evaluated = []
-    for condition in conditions.conditions:
-        evaluated.append(evaluate_condition(condition, environment))
+# unit -> inches
+unit_lookup = {
+    "in" : 1.0,
+    "ft" : 12.0,
+    "cm" : 1 / 2.54,
+    "m" : 100 / 2.54
+}
 
-    if all_true(evaluated):
+_metamodel = None
+_metamodel_lock = threading.Lock()
+
+def get_metamodel():
+    # the grammar is only compiled the first time a condition is
+    global _metamodel
+    with _metamodel_lock:
+        if _metamodel is None:
+            from textx.metamodel import metamodel_from_file
+            _metamodel = metamodel_from_file(os.path.join(path, file))
+    return _metamodel
+
+def __getattr__(name):
+    if name == "conditionling_metamodel":
+        return get_metamodel()
+    raise AttributeError(name)
+
+class Check(object):
+    # one comparison of a field against a value already in the
+    # environment's unit, field_first is False for "4.0 in < height"
+    __slots__ = ("symbol", "compare", "value", "field_first")
+
+    def __init__(self, symbol, value, field_first):
+        self.symbol = symbol
+        self.compare = operator_lookup[symbol]
+        self.value = value
+        self.field_first = field_first
+
+    def __call__(self, field_value):
+        if self.field_first:
+            return self.compare(field_value, self.value)
+        return self.compare(self.value, field_value)
+
+class CompiledCondition(object):
+    __slots__ = ("field", "checks")
+
+    def __init__(self, field, checks):
+        self.field = field
+        self.checks = tuple(checks)
+
+    def __call__(self, environment):
+        try:
+            field_value = environment[self.field]
+        except KeyError:
+            return False
+        if not self.checks:
+            return False
+        for check in self.checks:
+            if not check(field_value):
+                return False
         return True
-    else:
-        return False
 
-def evaluate_condition(condition, environment):
-
-    operator_lookup = {
-        "<" : operator.lt,
-        "<=" : operator.le,
-        "==" : operator.eq,
-        "!=" : operator.ne,
-        ">=" : operator.ge,
-        ">" : operator.gt
-    }
-
-    if condition.field in environment:
-        field_value = environment[condition.field]
-        if condition.left_compare:
-            left_result = operator_lookup[condition.left_compare.comparator_symbol.symbol](condition.left_compare.comparator_value, field_value)
-        else:
-            left_result = None
-
-        if condition.right_compare:
-            right_result = operator_lookup[condition.right_compare.comparator_symbol.symbol](field_value, condition.right_compare.comparator_value)
-        else:
-            right_result = None
-
-        results = [s for s in [left_result, right_result] if s is not None]
-
-        if all_true(results):
-            return True
-        else:
+class CompiledConditions(object):
+    # all conditions must hold, an empty set never does
+    __slots__ = ("source", "conditions")
+
+    def __init__(self, source, conditions):
+        self.source = source
+        self.conditions = tuple(conditions)
+
+    @property
+    def fields(self):
+        return {condition.field for condition in self.conditions}
+
+    def __call__(self, environment):
+        if not self.conditions:
             return False
-    else:
-        return False
+        for condition in self.conditions:
+            if not condition(environment):
+                return False
+        return True
+
+def compile_comparator(comparator, field_first, unit):
+    value = comparator.comparator_value * unit_lookup[comparator.unit] / unit_lookup[unit]
+    return Check(comparator.comparator_symbol.symbol, value, field_first)
+
+def compile_condition(condition, unit="in"):
+    checks = []
+    if condition.left_compare:
+        checks.append(compile_comparator(condition.left_compare, False, unit))
+    if condition.right_compare:
+        checks.append(compile_comparator(condition.right_compare, True, unit))
+    return CompiledCondition(condition.field, checks)
+
+@functools.lru_cache(maxsize=1024)
+def compile_conditions(dsl_string, unit="in"):
+    # unit is the unit of the values in the environments
+    # that the compiled conditions will be called with
+    conditions = get_metamodel().model_from_str(dsl_string)
+    return CompiledConditions(dsl_string, [compile_condition(condition, unit) for condition in conditions.conditions])
+
+def evaluate_conditions(dsl_string, environment, unit="in"):
+    return compile_conditions(dsl_string, unit)(environment)
+
+def evaluate_condition(condition, environment, unit="in"):
+    return compile_condition(condition, unit)(environment)
 
 def all_true(values):
-    if len(set(values)) == 1 and True in set(values):
-        return True
-    else:
+    if not values:
         return False
+    for value in values:
+        if value is not True:
+            return False
+    return True
 
 def test():
     dsl_string = "width > 5.0 in\n4.0 in < height > 50.0 in"
-    print(evaluate_conditions(dsl_string, {"height" : 10, "width" : 6}))
\ No newline at end of file
+    print(evaluate_conditions(dsl_string, {"height" : 10, "width" : 6}))
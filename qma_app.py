@@ -0,0 +1,872 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import uuid
+import copy
+import os
+import argparse
+import time
+from kivy.app import App
+from kivy.lang import Builder
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.scrollview import ScrollView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.uix.label import Label
+from kivy.uix.image import Image
+from kivy.uix.button import Button
+from kivy.uix.textinput import TextInput
+from kivy.uix.tabbedpanel import TabbedPanel, TabbedPanelItem
+from kivy.uix.colorpicker import ColorPicker
+from kivy.uix.dropdown import DropDown
+from kivy.uix.popup import Popup
+from kivy.core.window import Window
+from kivy.clock import Clock, mainthread
+from qma_parse import parse_cache
+from qma_sync import project_sync
+from qma_ingest import WipFeed, IngestWorker
+from qma_render import RenderCache, RedisTier, MemoryTier, RawImage, VIEWS
+from qma_textures import TextureAtlas, texture_bytes
+from qma_frames import FrameScheduler
+from qma_farm import RenderFarm, BACKGROUND
+from qma_thumbs import ThumbnailJobs
+from qma_conditions import compile_setset
+from qma_queue import WipQueue
+from qma_store import QueueStore
+from qma_metrics import metrics, MetricsExporter, Profiler
+from qma_procs import CallSupervisor
+from qma_xmlstore import MemoryXmlStore, DiskXmlStore, RedisXmlStore
+from qma_core import Call, SetSet, WipSet, configure_backend, load_settings, setting_to_dict, setting_from_dict
+
+class ColorPickerPopup(Popup):
+    def __init__(self, **kwargs):
+        self.title = "foo"
+        self.content = ColorPicker()
+        self.size_hint = (.5,.5)
+        super(ColorPickerPopup, self).__init__()
+
+class WipContainer(RecycleView):
+    # only the rows in the viewport have widgets, the queue itself is
+    # held in self.data as one small dict per wip, kept in the order
+    # of self.queue by following its change events
+    def __init__(self, app, wipset, **kwargs):
+        self.app = app
+        self.wipset = wipset
+        self.queue = WipQueue()
+        self.queue.bind(self.on_queue_change)
+        # positions of wips seen before, restored if they come back
+        self.queue_order = {}
+        # decoded fold thumbnails by xml hash
+        self.fold_textures = MemoryTier(32 * 1024 * 1024, texture_bytes, app.textures.release)
+        # xml hash -> row dict in self.data
+        self.rows = {}
+        self.active_hash = None
+        self.window_changed = False
+        self.rebuild_threshold = 32
+        # id of setset -> xml hashes meeting its conditions
+        self.setset_matches = {}
+        super(WipContainer, self).__init__(**kwargs)
+        layout = RecycleBoxLayout(orientation="vertical",
+                                  default_size=(None, 400),
+                                  default_size_hint=(1, None),
+                                  size_hint_y=None)
+        layout.bind(minimum_height=layout.setter("height"))
+        self.add_widget(layout)
+        # set after the layout is added, the layout manager keeps its own copy
+        self.viewclass = WipItem
+
+    @metrics.timed("queue_update")
+    def update(self):
+        # reconcile the queue with the wipset, small changes are applied
+        # as single inserts, removals and moves, large ones rebuild
+        wips = self.wipset.wips
+        removed = [xml_hash for xml_hash in self.rows if xml_hash not in wips]
+        added = [xml_hash for xml_hash in wips if xml_hash not in self.rows]
+        moved = [xml_hash for xml_hash in self.rows if xml_hash in wips and wips[xml_hash].queue_position != self.queue.position(xml_hash)]
+        for xml_hash in added:
+            try:
+                wips[xml_hash].queue_position = self.queue_order[xml_hash]
+            except KeyError:
+                pass
+        self.evaluate_setsets()
+
+        if len(removed) + len(added) + len(moved) > max(self.rebuild_threshold, len(self.rows) // 4):
+            self.sort_queue()
+            return
+
+        for xml_hash in removed:
+            self.queue.remove(xml_hash)
+        for xml_hash in moved:
+            self.reposition(xml_hash, update_active=False)
+        for xml_hash in added:
+            self.queue_order[xml_hash] = wips[xml_hash].queue_position
+            self.queue.insert(xml_hash, wips[xml_hash].queue_position)
+        self.update_active()
+
+    def on_queue_change(self, event, xml_hash, old_index, new_index):
+        if event == "insert":
+            row = {"xml_str_hash" : xml_hash, "active" : False}
+            self.rows[xml_hash] = row
+            self.data.insert(new_index, row)
+        elif event == "remove":
+            del self.rows[xml_hash]
+            self.data.pop(old_index)
+        elif event == "move":
+            self.data.insert(new_index, self.data.pop(old_index))
+        elif event == "reset":
+            rows = [self.rows.get(xml_hash) or {"xml_str_hash" : xml_hash, "active" : False} for xml_hash in self.queue]
+            self.rows = {row["xml_str_hash"] : row for row in rows}
+            self.data = rows
+        self.store_change(event, xml_hash)
+        # thumbnails only need another look when the head or the
+        # prefetched rows after it were touched
+        window = self.app.thumbnail_prefetch
+        if event == "reset" or min(index for index in (old_index, new_index) if index is not None) <= window:
+            self.window_changed = True
+
+    def store_change(self, event, xml_hash):
+        # buffered by the store, flushed on its own thread
+        store = self.app.store
+        if store is None:
+            return
+        if event in ("insert", "move"):
+            store.set_position(xml_hash, self.queue.position(xml_hash))
+        elif event == "remove":
+            store.remove_position(xml_hash)
+        elif event == "reset":
+            for xml_hash in self.queue:
+                store.set_position(xml_hash, self.queue.position(xml_hash))
+
+    def reposition(self, xml_hash, update_active=True):
+        position = self.wipset.wips[xml_hash].queue_position
+        self.queue_order[xml_hash] = position
+        self.queue.reposition(xml_hash, position)
+        if update_active:
+            self.update_active()
+
+    def set_row_active(self, xml_hash, active):
+        row = self.rows[xml_hash]
+        row["active"] = active
+        # reassigning the item refreshes only that row
+        self.data[self.queue.index(xml_hash)] = row
+
+    def update_active(self):
+        active_hash = self.queue.head()
+        if active_hash != self.active_hash:
+            if self.active_hash in self.rows:
+                self.set_row_active(self.active_hash, False)
+            self.active_hash = active_hash
+            if active_hash is not None:
+                self.set_row_active(active_hash, True)
+        if self.window_changed:
+            self.window_changed = False
+            self.prefetch_thumbnails()
+            self.prefetch_renders()
+
+    def refresh_visible(self):
+        # for settings changes, only rows with widgets need redrawing.
+        # edits call this per keystroke, rows are redrawn one frame later
+        self.app.frames.refresh(self.redraw_visible)
+
+    def redraw_visible(self):
+        self.evaluate_setsets()
+        for view in self.layout_manager.children:
+            self.app.frames.add((view, "redraw"), lambda view=view: self.redraw_row(view))
+
+    def redraw_row(self, view):
+        if view.index is not None and view.index < len(self.data):
+            view.update_actions()
+            view.refresh_view_attrs(self, view.index, self.data[view.index])
+
+    def setsets(self):
+        return [s.item for s in self.app.setting_container.settings_container.children if isinstance(s.item, SetSet)]
+
+    def evaluate_setsets(self):
+        # the wipset index keeps match sets current as wips come and go,
+        # only new or edited setsets are looked up here
+        index = self.wipset.index
+        index.set_setsets({id(setset) : compile_setset(setset) for setset in self.setsets()})
+        self.setset_matches = index.matches
+
+    @metrics.timed("queue_rebuild")
+    def sort_queue(self):
+        # full rebuild of the queue from the wipset
+        self.evaluate_setsets()
+        for wip_name, wip in self.wipset.wips.items():
+            self.queue_order[wip.xml_str_hash] = wip.queue_position
+        self.queue.reset((wip.xml_str_hash, wip.queue_position) for wip in self.wipset.wips.values())
+        for row in self.rows.values():
+            row["active"] = False
+        self.active_hash = None
+        self.update_active()
+
+    def prefetch_thumbnails(self):
+        # the head of the queue is rendered first, the next few rows
+        # after it so advancing the queue finds them in the cache
+        upcoming = self.queue.range(0, self.app.thumbnail_prefetch + 1)
+        self.app.thumbnails.cancel(keep=upcoming)
+        for index, xml_hash in enumerate(upcoming):
+            # xml is only read from the store when a job will run
+            wip = self.wipset.wips[xml_hash]
+            cached = self.app.thumbnails.cached(xml_hash)
+            if index == 0:
+                if self.fold_textures.get(xml_hash) is None:
+                    self.app.thumbnails.request(xml_hash, None if cached else wip.xml_str, callback=self.thumbnail_ready, errback=self.thumbnail_failed, urgent=True)
+            elif not cached:
+                self.app.thumbnails.request(xml_hash, wip.xml_str, errback=self.thumbnail_failed)
+
+    def prefetch_renders(self):
+        # with a render farm, the head of the queue renders before the rest
+        if self.app.render_farm is None:
+            return
+        for index, xml_hash in enumerate(self.queue.range(0, self.app.thumbnail_prefetch + 1)):
+            for view in VIEWS:
+                self.app.render_farm.request(self.wipset.wips[xml_hash], view, priority=1 + index, callback=self.render_ready)
+
+    @mainthread
+    def render_ready(self, wip, view, image):
+        xml_hash = wip.xml_str_hash
+        if xml_hash not in self.rows:
+            return
+        self.app.render_cache.put_view(wip, view, image)
+        # reassigning the item refreshes only that row
+        self.data[self.queue.index(xml_hash)] = self.rows[xml_hash]
+
+    def thumbnail_ready(self, job, data):
+        # decoded on the reaper thread, only the upload is left for the frame
+        self.show_thumbnail(job.xml_hash, RawImage.from_encoded(data))
+
+    @mainthread
+    def show_thumbnail(self, xml_hash, image):
+        self.fold_textures.put(xml_hash, self.app.textures.texture(image))
+        if xml_hash == self.active_hash:
+            self.set_row_active(xml_hash, True)
+
+    @mainthread
+    def thumbnail_failed(self, job, message):
+        print("fold thumbnail for {} failed: {}".format(job.xml_hash, message))
+
+class WipItem(RecycleDataViewBehavior, BoxLayout):
+    # a recycled row, refresh_view_attrs points it at another wip
+    def __init__(self, **kwargs):
+        self.wip = None
+        self.index = None
+        self.image_project_dimensions = Image()
+        self.image_project_overview = Image()
+        self.image_project_folds = Image(height=0, width=0)
+        self.actions_container = BoxLayout(orientation="horizontal", size_hint_y=None)
+        super(WipItem, self).__init__(**kwargs)
+        self.queue_input = TextInput(text="", size_hint_x=None, multiline=False)
+        self.queue_input.bind(on_text_validate=lambda widget: self.update_queue_position())
+        self.add_widget(self.queue_input)
+
+        self.add_widget(self.image_project_dimensions)
+        self.add_widget(self.image_project_overview)
+        self.add_widget(self.image_project_folds)
+        self.add_widget(self.actions_container)
+
+        self.conditions_container = BoxLayout(orientation="horizontal", size_hint_y=None, size_hint_x=None)
+        self.add_widget(self.conditions_container)
+
+        self.update_actions()
+
+    @metrics.timed("row_refresh")
+    def refresh_view_attrs(self, rv, index, data):
+        self.index = index
+        self.wip = rv.wipset.wips[data["xml_str_hash"]]
+        self.queue_input.text = str(self.wip.queue_position)
+        if data["active"]:
+            self.queue_input.background_color = (0, 1, 0, 1)
+            self.image_project_folds.texture = rv.fold_textures.get(self.wip.xml_str_hash)
+        else:
+            self.queue_input.background_color = (1, 1, 1, 1)
+            self.image_project_folds.texture = None
+
+        self.conditions_container.clear_widgets()
+        for setset in rv.setsets():
+            # setsets whose conditions this wip does not meet are faded
+            matched = self.wip.xml_str_hash in rv.setset_matches.get(id(setset), ())
+            b = Button(text=str(setset.conditions), background_normal='', background_color=(*setset.color.rgb, 1 if matched else .3))
+            self.conditions_container.add_widget(b)
+
+        # images already decoded are shown now, others load within the
+        # frame budget so a fast scroll does not decode every row it passes
+        app = App.get_running_app()
+        render_cache = app.render_cache
+        self.show_images(render_cache.view_cached(self.wip, "overview"), render_cache.view_cached(self.wip, "dimensions"))
+        if self.image_project_overview.texture is None or self.image_project_dimensions.texture is None:
+            app.frames.add((self, "images"), lambda wip=self.wip: self.load_images(wip))
+        else:
+            app.frames.cancel((self, "images"))
+
+    @metrics.timed("row_images")
+    def load_images(self, wip):
+        if wip is not self.wip:
+            return
+        app = App.get_running_app()
+        if app.render_farm is not None:
+            # visible rows go ahead of everything else
+            for view in VIEWS:
+                if app.render_cache.view_cached(wip, view) is None:
+                    app.render_farm.request(wip, view, priority=0, callback=app.wips_container.render_ready)
+            return
+        render_cache = app.render_cache
+        self.show_images(render_cache.view(wip, "overview"), render_cache.view(wip, "dimensions"))
+
+    def show_images(self, overview, dimensions):
+        self.image_project_overview.texture = overview
+        self.image_project_overview.size = self.image_project_overview.texture_size
+        self.image_project_dimensions.texture = dimensions
+        self.image_project_dimensions.size = self.image_project_dimensions.texture_size
+
+    def update_queue_position(self):
+        try:
+            self.wip.queue_position = int(self.queue_input.text)
+            App.get_running_app().wips_container.reposition(self.wip.xml_str_hash)
+        except Exception as ex:
+            print(ex)
+
+    def update_actions(self):
+        self.actions_container.clear_widgets()
+        try:
+            for action in App.get_running_app().settings:
+                if isinstance(action.item, Call):
+                    btn = None
+                    btn = Button(text=action.item.value, size_hint_x=None, size_hint_y=None, height=44)
+                    btn.background_normal = ''
+                    btn.background_color = (*action.item.color.rgb, 1)
+                    # bind action item for lambda using item=
+                    f = lambda widget, item=action.item: item.action(App.get_running_app().calls, self.wip.xml_str_hash if self.wip else None)
+                    btn.bind(on_press = f)
+                    self.actions_container.add_widget(btn)
+        except AttributeError:
+            # no running app while the first rows are built
+            pass
+
+class SetItem(BoxLayout):
+    def __init__(self, item, **kwargs):
+        self.item = item
+        self.item_color_button = Button(text= "", background_normal='', font_size=20)
+        self.item_color_button.bind(on_press=self.pick_color)
+        if self.item is not None:
+            self.item_color_button.background_color = (*self.item.color.rgb, 1)
+        self.item_delete_button = Button(text="del", size_hint_x=None)
+        self.item_delete_button.bind(on_press=lambda widget: self.remove())
+        super(SetItem, self).__init__(**kwargs)
+        self.add_widget(self.item_color_button)
+        self.item_container = BoxLayout(orientation="horizontal")
+        self.add_widget(self.item_container)
+        if item is not None:
+            self.type_fields()
+        else:
+            self.configure()
+
+        self.add_widget(self.item_delete_button)
+
+    def configure(self):
+        type_dd = self.create_dropdown(["call", "setset"], callback=self.select_type)
+        self.add_widget(type_dd)
+
+    def remove(self):
+        self.parent.parent.remove_item(self)
+
+    def action(self):
+        self.item.action()
+
+    def update_item_field(self, item, field, value, field_widget, split=False):
+        if split:
+            setattr(item, field, value.split(split))
+        else:
+            setattr(item, field, value)
+        field_widget.text = value
+        #field_widget.hint_text = value
+        try:
+            App.get_running_app().wips_container.refresh_visible()
+            App.get_running_app().save()
+        except AttributeError:
+            pass
+
+    def select_type(self, item_type):
+        self.item_container.clear_widgets()
+        if item_type == "call":
+            self.item = Call()
+        if item_type == "setset":
+            self.item = SetSet()
+        self.item_color_button.background_color = (1, 1, 1, 1)
+        self.type_fields()
+        App.get_running_app().save()
+
+    def type_fields(self):
+        type_widgets = None
+        if isinstance(self.item, Call):
+            type_widgets = BoxLayout(orientation="horizontal")
+            call_input = TextInput(hint_text="call", multiline=False)
+            call_input.bind(on_text_validate=lambda widget: self.update_item_field(self.item, "value", widget.text, widget))
+            type_widgets.add_widget(call_input)
+            args_input = TextInput(hint_text="comma separated args", multiline=False)
+            args_input.bind(on_text_validate=lambda widget: self.update_item_field(self.item, "args", widget.text, widget, split=","))
+
+            type_widgets.add_widget(args_input)
+        elif isinstance(self.item, SetSet):
+            type_widgets = BoxLayout(orientation="horizontal")
+            attribute_input = TextInput(hint_text="attribute to set", multiline=False)
+            attribute_input.bind(on_text_validate=lambda widget: self.update_item_field(self.item, "attribute", widget.text, widget))
+            value_input = TextInput(hint_text="set to value", multiline=False)
+            value_input.bind(on_text_validate=lambda widget: self.update_item_field(self.item, "value", widget.text, widget))
+            conditions_input = TextInput(hint_text="comma separated conditions", multiline=False)
+            conditions_input.bind(on_text_validate=lambda widget: self.update_item_field(self.item, "conditions", widget.text, widget, split=","))
+            type_widgets.add_widget(attribute_input)
+            type_widgets.add_widget(value_input)
+            type_widgets.add_widget(conditions_input)
+        if type_widgets is not None:
+            self.item_container.add_widget(type_widgets)
+
+    def create_dropdown(self, values, callback=None):
+        d = DropDown()
+        setattr(self, "dd_" + str(uuid.uuid4()), d)
+        d_default = Button(text="")
+        d_default.bind(on_release=d.open)
+        for value in values:
+            btn = Button(text=value, size_hint_y=None, height=44)
+            btn.bind(on_release=lambda btn: d.select(btn.text))
+            d.add_widget(btn)
+        d.bind(on_select=lambda instance, x: self.dropdown_update(instance, x, d_default))
+        if callback is not None:
+            d.bind(on_select=lambda instance, x: callback(x))
+
+        return d_default
+
+    def dropdown_update(self, widget, selected_value, default, *args):
+        default.text = selected_value
+
+    def pick_color(self,*args):
+        color_picker = ColorPickerPopup()
+        color_picker.content.bind(color=self.on_color)
+        color_picker.open()
+
+    def on_color(self, instance, *args):
+        # self.item may not exist
+        try:
+            self.item.color.rgb = instance.color[:3]
+            self.item_color_button.background_color = (*self.item.color.rgb, 1)
+            self.parent.parent.app.wips_container.refresh_visible()
+            self.parent.parent.app.save()
+        except AttributeError:
+            pass
+
+class ProcessContainer(BoxLayout):
+    # calls started from the queue, running ones first
+    def __init__(self, app, **kwargs):
+        self.app = app
+        super(ProcessContainer, self).__init__(orientation="vertical", **kwargs)
+        self.rows = BoxLayout(orientation="vertical", size_hint_y=None)
+        self.rows.bind(minimum_height=self.rows.setter("height"))
+        scroll = ScrollView()
+        scroll.add_widget(self.rows)
+        self.add_widget(scroll)
+
+    def update(self, dt=None):
+        self.rows.clear_widgets()
+        for call_process in self.app.calls.processes():
+            row = BoxLayout(orientation="horizontal", size_hint_y=None, height=44)
+            if call_process.running:
+                rss = call_process.rss()
+                cpu = call_process.cpu_seconds()
+                status = "running {:.0f}s  {}  cpu {}".format(call_process.runtime(),
+                                                              "{:.0f}MB".format(rss / 1024 / 1024) if rss is not None else "",
+                                                              "{:.1f}s".format(cpu) if cpu is not None else "")
+            else:
+                status = "exit {} after {:.0f}s".format(call_process.returncode, call_process.runtime())
+            row.add_widget(Label(text=str(call_process.pid), size_hint_x=None, width=80))
+            row.add_widget(Label(text=" ".join([call_process.command, *call_process.args])))
+            row.add_widget(Label(text=(call_process.xml_hash or "")[:12], size_hint_x=None, width=140))
+            row.add_widget(Label(text=status))
+            if call_process.running:
+                stop = Button(text="stop", size_hint_x=None, width=80)
+                stop.bind(on_press=lambda widget, call_process=call_process: self.app.calls.stop(call_process))
+                row.add_widget(stop)
+            self.rows.add_widget(row)
+
+class SettingContainer(BoxLayout):
+    def __init__(self, app, **kwargs):
+        self.app = app
+        self.settings = self.app.settings
+        self.settings_container = BoxLayout(orientation="vertical")
+        super(SettingContainer, self).__init__(**kwargs)
+        self.create_button = Button(text="create", size_hint_x=None)
+        self.create_button.bind(on_press=lambda widget: self.create_item())
+        self.add_widget(self.settings_container)
+        self.add_widget(self.create_button)
+        self.update_widgets()
+
+    def update_widgets(self):
+        self.settings_container.clear_widgets()
+        for widget in self.settings:
+            self.settings_container.add_widget(widget)
+
+    def create_item(self):
+        w = SetItem(None)
+        self.settings_container.add_widget(w)
+
+    def remove_item(self, item):
+        self.settings_container.remove_widget(item)
+        del item
+        self.app.save()
+
+class QueueApp(App):
+    def __init__(self, *args,**kwargs):
+        self.queued = {}
+        self.settings = []
+        self.project_files = []
+        self.sync_mode = "notify"
+        self.reconcile_interval = 300
+        if "project_file" in kwargs:
+            self.project_files = kwargs["project_file"]
+        if "sync" in kwargs:
+            self.sync_mode = kwargs["sync"]
+        if "reconcile_interval" in kwargs:
+            self.reconcile_interval = kwargs["reconcile_interval"]
+        self.batch_size = kwargs.get("batch_size", 500)
+        parse_cache.max_entries = kwargs.get("parse_cache_size", parse_cache.max_entries)
+        # fetching, parsing and rendering happen on the ingest thread,
+        # finished wips are picked up each frame by drain_ingest
+        backend = configure_backend(kwargs.get("redis_node"), cluster=kwargs.get("redis_cluster", False), timeout=kwargs.get("redis_timeout", 5))
+        binary_r, redis_conn = backend.binary, backend.decoded
+        # project xml is kept out of memory unless asked for
+        xml_store = kwargs.get("xml_store", "disk")
+        if xml_store == "redis" and binary_r is not None:
+            self.wips = WipSet(xml_store=RedisXmlStore(binary_r))
+        elif xml_store == "memory":
+            self.wips = WipSet(xml_store=MemoryXmlStore())
+        else:
+            self.wips = WipSet(xml_store=DiskXmlStore(kwargs.get("xml_store_dir", os.path.expanduser("~/.cache/qma-ui/xml"))))
+        shared_renders = None
+        if kwargs.get("shared_render_cache") and binary_r is not None:
+            shared_renders = RedisTier(binary_r)
+        # project images go from pixels to a slot in a shared texture,
+        # jpegs are only kept on disk and in redis
+        self.textures = TextureAtlas(kwargs.get("texture_atlas_size", 1024), in_use=self.shown_textures)
+        self.render_cache = RenderCache(kwargs.get("render_cache_dir", os.path.expanduser("~/.cache/qma-ui/renders")),
+                                        shared=shared_renders,
+                                        memory_bytes=kwargs.get("texture_cache_mb", 128) * 1024 * 1024,
+                                        decode=self.textures.texture,
+                                        sizeof=texture_bytes,
+                                        evict=self.textures.release,
+                                        disk_bytes=kwargs.get("disk_cache_mb", 1024) * 1024 * 1024)
+        # with render workers, views are rendered by a process pool
+        # instead of one after another on the ingest thread
+        self.render_farm = None
+        prepare = self.render_cache.prepare
+        if kwargs.get("render_workers", 0) > 0:
+            self.render_farm = RenderFarm(self.render_cache, workers=kwargs["render_workers"])
+            prepare = self.prepare_renders
+        self.feed = WipFeed(self.wips.load_project_xml, prepare=prepare)
+        self.thumbnail_prefetch = kwargs.get("thumbnail_prefetch", 3)
+        self.thumbnails = ThumbnailJobs(cache_directory=kwargs.get("thumbnail_cache_dir", os.path.expanduser("~/.cache/qma-ui/thumbnails")),
+                                        max_running=kwargs.get("thumbnail_jobs", 2),
+                                        cache_bytes=kwargs.get("disk_cache_mb", 1024) * 1024 * 1024)
+        # queue positions and settings shared through redis
+        self.store = None
+        if redis_conn is not None:
+            self.store = QueueStore(redis_conn, flush_interval=kwargs.get("flush_interval", 1.0), on_change=self.remote_positions)
+        # one ProjectSync per node, run in parallel when there are several
+        sync = project_sync(backend.shards(), self.feed, batch_size=self.batch_size, cluster=backend.cluster is not None)
+        self.ingest = IngestWorker(self.feed,
+                                   sync,
+                                   files=self.project_files,
+                                   mode=self.sync_mode,
+                                   reconcile_interval=self.reconcile_interval)
+        self.calls = CallSupervisor(limits=dict(kwargs.get("call_limits", [])), default_limit=kwargs.get("call_limit", 1))
+        self.stats_overlay = kwargs.get("stats_overlay", False)
+        self.frames = FrameScheduler(budget=kwargs.get("frame_budget_ms", 8) / 1000)
+        self.stats_label = None
+        self.profiler = Profiler(kwargs.get("profile_dir", os.path.expanduser("~/.cache/qma-ui/profiles")))
+        self.metrics_exporter = None
+        if kwargs.get("metrics_textfile") or (kwargs.get("metrics_redis") and redis_conn is not None):
+            self.metrics_exporter = MetricsExporter(metrics,
+                                                    textfile=kwargs.get("metrics_textfile"),
+                                                    redis_conn=redis_conn if kwargs.get("metrics_redis") else None,
+                                                    interval=kwargs.get("metrics_interval", 10))
+        super(QueueApp, self).__init__()
+
+    def prepare_renders(self, wip):
+        for view in VIEWS:
+            self.render_farm.request(wip, view, priority=BACKGROUND)
+
+    def drain_ingest(self, dt):
+        # scheduled every frame, so dt is the frame time. a large sync
+        # is taken in over several frames, each within the frame budget,
+        # and the queue is updated at most once a frame
+        metrics.observe("frame", dt)
+        changed = False
+        deadline = self.frames.deadline()
+        for action, source, wip in self.feed.drain():
+            if action == "add":
+                changed |= self.wips.put(wip, source)
+            else:
+                changed |= self.wips.remove(source)
+            if time.perf_counter() >= deadline:
+                break
+        if changed:
+            self.frames.refresh(self.wips_container.update)
+
+    def load(self, file):
+        self.settings.extend(SetItem(obj) for obj in load_settings(file))
+
+    def restore(self):
+        # one read for positions and settings, default.xml
+        # is only used when no settings have been saved
+        positions, settings = {}, []
+        if self.store is not None:
+            positions, settings = self.store.restore()
+        if settings:
+            self.settings = [SetItem(setting_from_dict(setting)) for setting in settings]
+        else:
+            self.load("default.xml")
+        return positions
+
+    def shown_textures(self):
+        # textures of rows that have widgets
+        try:
+            views = self.wips_container.layout_manager.children
+        except AttributeError:
+            return []
+        return [image.texture for view in views for image in (view.image_project_overview, view.image_project_dimensions, view.image_project_folds)]
+
+    @mainthread
+    def remote_positions(self, positions):
+        # another station or qma_cli moved wips in the shared queue
+        container = self.wips_container
+        for xml_hash, position in positions.items():
+            container.queue_order[xml_hash] = position
+            wip = self.wips.wips.get(xml_hash)
+            if wip is not None:
+                wip.queue_position = position
+        self.frames.refresh(container.update)
+
+    def save(self):
+        if self.store is None:
+            return
+        try:
+            items = [widget.item for widget in reversed(self.setting_container.settings_container.children)]
+        except AttributeError:
+            return
+        self.store.set_settings(setting_to_dict(item) for item in items if item is not None)
+
+    def on_stop(self):
+        self.ingest.stop()
+        self.thumbnails.cancel()
+        if self.store is not None:
+            self.store.stop()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+        if self.render_farm is not None:
+            self.render_farm.stop()
+
+    def register_gauges(self):
+        metrics.gauge("queue_depth", lambda: len(self.wips_container.queue))
+        metrics.gauge("ingest_pending", self.feed.queue.qsize)
+        metrics.gauge("thumbnails_running", lambda: len(self.thumbnails.jobs))
+        metrics.gauge("thumbnails_pending", lambda: len(self.thumbnails.pending))
+        metrics.gauge("parse_cache_hits", lambda: parse_cache.hits)
+        metrics.gauge("parse_cache_misses", lambda: parse_cache.misses)
+        metrics.gauge("frame_pending", self.frames.pending)
+        if self.render_farm is not None:
+            metrics.gauge("farm_pending", self.render_farm.pending)
+        metrics.gauge("calls_running", lambda: len(self.calls.running))
+        metrics.gauge("texture_cache_bytes", lambda: self.render_cache.memory.bytes)
+        metrics.gauge("fold_texture_bytes", lambda: self.wips_container.fold_textures.bytes)
+        metrics.gauge("texture_atlas_bytes", lambda: self.textures.bytes)
+
+    def update_stats(self, dt):
+        values = metrics.snapshot()
+        lines = []
+        for name in ("queue_depth", "ingest_pending", "frame_pending", "thumbnails_running", "thumbnails_pending"):
+            lines.append("{} {}".format(name, values.get(name, 0)))
+        for name in ("frame", "frame_work", "queue_update", "row_refresh", "row_images", "render", "ingest_load", "sync_reconcile", "thumbnail_job"):
+            count = values.get(name + "_count", 0)
+            if count:
+                lines.append("{} {:.1f}ms avg {:.1f}ms max".format(name,
+                                                                   1000 * values[name + "_seconds_sum"] / count,
+                                                                   1000 * values[name + "_seconds_max"]))
+        self.stats_label.text = "\n".join(lines)
+        self.stats_label.texture_update()
+        self.stats_label.size = self.stats_label.texture_size
+        self.stats_label.pos = (Window.width - self.stats_label.width - 10, Window.height - self.stats_label.height - 40)
+
+    def toggle_stats(self):
+        if self.stats_label is None:
+            self.stats_label = Label(halign="left", color=(1, 1, 0, 1))
+            self.stats_event = Clock.schedule_interval(self.update_stats, .5)
+            Window.add_widget(self.stats_label)
+        else:
+            self.stats_event.cancel()
+            Window.remove_widget(self.stats_label)
+            self.stats_label = None
+
+    def on_keyboard(self, window, key, scancode, codepoint, modifiers):
+        # f11 stats overlay, f12 start or stop a cProfile capture
+        if key == 292:
+            self.toggle_stats()
+            return True
+        if key == 293:
+            self.profiler.toggle()
+            return True
+        return False
+
+    def build(self):
+        root = BoxLayout()
+        root = TabbedPanel(do_default_tab=False)
+        root.tab_width = 200
+        positions = self.restore()
+
+        self.wips_container = WipContainer(self,
+                                           self.wips,
+                                           bar_width=20,
+                                           scroll_type=["bars", "content"])
+        self.wips_container.queue_order.update(positions)
+
+        tab = TabbedPanelItem(text="queue")
+        tab.add_widget(self.wips_container)
+        root.add_widget(tab)
+
+        tab = TabbedPanelItem(text="settings")
+        self.setting_container = SettingContainer(self)
+        tab.add_widget(self.setting_container)
+        self.setting_container.update_widgets()
+        root.add_widget(tab)
+
+        tab = TabbedPanelItem(text="processes")
+        self.process_container = ProcessContainer(self)
+        tab.add_widget(self.process_container)
+        root.add_widget(tab)
+        Clock.schedule_interval(self.process_container.update, 2)
+
+        self.register_gauges()
+        Window.bind(on_keyboard=self.on_keyboard)
+        if self.stats_overlay:
+            self.toggle_stats()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.start()
+
+        if self.render_farm is not None:
+            self.render_farm.start()
+        self.ingest.start()
+        if self.store is not None:
+            self.store.start()
+        Clock.schedule_interval(self.drain_ingest, 0)
+        return root
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project-file",
+                        nargs='+',
+                        default=[],
+                        help="project file(s) in xml")
+    parser.add_argument("--redis-node",
+                        nargs='+',
+                        default=None,
+                        help="redis nodes holding projects as host:port/db, the first also holds queue state. default is the ma service connection")
+    parser.add_argument("--redis-cluster",
+                        action="store_true",
+                        help="--redis-node are startup nodes of a redis cluster")
+    parser.add_argument("--redis-timeout",
+                        type=float,
+                        default=5,
+                        help="seconds before a redis connection or command times out")
+    parser.add_argument("--sync",
+                        choices=["notify", "poll"],
+                        default="notify",
+                        help="follow redis keyspace notifications or rescan every 10 seconds")
+    parser.add_argument("--reconcile-interval",
+                        type=float,
+                        default=300,
+                        help="seconds between full rescans when using --sync notify")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=500,
+                        help="keys fetched per redis round trip")
+    parser.add_argument("--parse-cache-size",
+                        type=int,
+                        default=4096,
+                        help="parsed projects kept in memory")
+    parser.add_argument("--texture-cache-mb",
+                        type=int,
+                        default=128,
+                        help="memory budget for decoded project images")
+    parser.add_argument("--texture-atlas-size",
+                        type=int,
+                        default=1024,
+                        help="width and height of the textures project images are packed into, 0 gives each image its own")
+    parser.add_argument("--render-cache-dir",
+                        default=os.path.expanduser("~/.cache/qma-ui/renders"),
+                        help="directory for encoded project images")
+    parser.add_argument("--shared-render-cache",
+                        action="store_true",
+                        help="share encoded project images with other instances through redis")
+    parser.add_argument("--disk-cache-mb",
+                        type=int,
+                        default=1024,
+                        help="size each of the render and thumbnail cache directories is pruned to")
+    parser.add_argument("--xml-store",
+                        choices=["disk", "memory", "redis"],
+                        default="disk",
+                        help="where project xml is kept between fold thumbnail renders")
+    parser.add_argument("--xml-store-dir",
+                        default=os.path.expanduser("~/.cache/qma-ui/xml"),
+                        help="directory for --xml-store disk")
+    parser.add_argument("--render-workers",
+                        type=int,
+                        default=0,
+                        help="processes rendering project images, 0 renders on the ingest thread")
+    parser.add_argument("--thumbnail-cache-dir",
+                        default=os.path.expanduser("~/.cache/qma-ui/thumbnails"),
+                        help="directory for fold thumbnails")
+    parser.add_argument("--thumbnail-prefetch",
+                        type=int,
+                        default=3,
+                        help="queue positions after the active one to render fold thumbnails for")
+    parser.add_argument("--thumbnail-jobs",
+                        type=int,
+                        default=2,
+                        help="fold thumbnail renders running at once")
+    parser.add_argument("--flush-interval",
+                        type=float,
+                        default=1.0,
+                        help="seconds between writes of queue positions and settings to redis")
+    parser.add_argument("--call-limit",
+                        type=int,
+                        default=1,
+                        help="instances of each call command allowed at once")
+    parser.add_argument("--call-limits",
+                        nargs='+',
+                        default=[],
+                        type=lambda limit: (limit.rpartition("=")[0], int(limit.rpartition("=")[2])),
+                        help="per command limits, for example fold-ui=2 dss-ui=1")
+    parser.add_argument("--metrics-textfile",
+                        default=None,
+                        help="write metrics in prometheus text format to this file")
+    parser.add_argument("--metrics-redis",
+                        action="store_true",
+                        help="write metrics to the qma:metrics redis hash")
+    parser.add_argument("--metrics-interval",
+                        type=float,
+                        default=10,
+                        help="seconds between metrics writes")
+    parser.add_argument("--frame-budget-ms",
+                        type=float,
+                        default=8,
+                        help="time each frame may spend building rows and taking in projects")
+    parser.add_argument("--stats-overlay",
+                        action="store_true",
+                        help="show timings on screen, f11 toggles")
+    parser.add_argument("--profile-dir",
+                        default=os.path.expanduser("~/.cache/qma-ui/profiles"),
+                        help="where f12 cProfile captures are written")
+    args = parser.parse_args()
+    app = QueueApp(**vars(args))
+    app.run()
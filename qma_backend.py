@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import threading
+import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+# redis connections shared by every part of qma-ui. each node has one
+# pool for binary and one for decoded clients, with timeouts and a
+# short exponential backoff between reconnect attempts. projects may
+# be sharded over several nodes or a cluster, the first node (or the
+# cluster itself) holds the queue state, metrics and shared caches
+
+def parse_node(node):
+    # "host", "host:port" or "host:port/db"
+    node, _, db = node.partition("/")
+    host, _, port = node.partition(":")
+    return host or "127.0.0.1", int(port or 6379), int(db or 0)
+
+class RedisBackend(object):
+    def __init__(self, nodes=None, cluster=False, timeout=5, retries=3, max_connections=32):
+        # nodes is a list of (host, port, db), None looks up the
+        # ma service connection
+        self.timeout = timeout
+        self.retries = retries
+        self.max_connections = max_connections
+        self.cluster = None
+        self.pools = {}
+        self.lock = threading.Lock()
+        if nodes is None:
+            nodes = self.service_nodes()
+        self.nodes = list(nodes)
+        if cluster and self.nodes:
+            from redis.cluster import RedisCluster, ClusterNode
+            try:
+                self.cluster = RedisCluster(startup_nodes=[ClusterNode(host, port) for host, port, db in self.nodes],
+                                            decode_responses=True,
+                                            socket_timeout=timeout,
+                                            socket_connect_timeout=timeout,
+                                            retry=self.retry())
+                self.binary_cluster = RedisCluster(startup_nodes=[ClusterNode(host, port) for host, port, db in self.nodes],
+                                                   socket_timeout=timeout,
+                                                   socket_connect_timeout=timeout,
+                                                   retry=self.retry())
+            except redis.exceptions.RedisClusterException as ex:
+                print("could not reach cluster {}: {}".format(self.nodes, ex))
+                self.nodes = []
+
+    @staticmethod
+    def service_nodes():
+        try:
+            from ma_cli import data_models
+            host, port = data_models.service_connection()
+        except (ImportError, redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as ex:
+            print("no redis service: {}".format(ex))
+            return []
+        return [(host, int(port), 0)]
+
+    def retry(self):
+        return Retry(ExponentialBackoff(cap=1, base=0.05), self.retries)
+
+    def client(self, node, decode_responses=True):
+        # clients are cheap, the pools behind them are shared
+        key = (node, decode_responses)
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                host, port, db = node
+                pool = redis.BlockingConnectionPool(host=host,
+                                                    port=port,
+                                                    db=db,
+                                                    decode_responses=decode_responses,
+                                                    max_connections=self.max_connections,
+                                                    timeout=self.timeout,
+                                                    socket_timeout=self.timeout,
+                                                    socket_connect_timeout=self.timeout,
+                                                    health_check_interval=30,
+                                                    retry=self.retry())
+                self.pools[key] = pool
+        return redis.StrictRedis(connection_pool=pool)
+
+    @property
+    def decoded(self):
+        # for queue state, settings and metrics, None without redis
+        if self.cluster is not None:
+            return self.cluster
+        if not self.nodes:
+            return None
+        return self.client(self.nodes[0])
+
+    @property
+    def binary(self):
+        # for encoded images and stored xml
+        if self.cluster is not None:
+            return self.binary_cluster
+        if not self.nodes:
+            return None
+        return self.client(self.nodes[0], decode_responses=False)
+
+    def shards(self):
+        # (name, decoded client) of every node holding projects
+        if self.cluster is not None:
+            return [("{}:{}".format(node.host, node.port), node.redis_connection) for node in self.cluster.get_primaries()]
+        return [("{}:{}/{}".format(*node), self.client(node)) for node in self.nodes]
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.disconnect()
@@ -0,0 +1,216 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+from xml.sax.saxutils import quoteattr
+from qma_core import WipSet, SetSet
+from qma_parse import parse_cache
+from qma_queue import WipQueue
+from qma_conditions import evaluate_setsets, compile_setset, project_environment
+
+# timings of the hot paths over synthetic projects, printed as json
+#   python3 qma_bench.py --sizes 10 1000 10000 --output bench.json
+#
+# project loading from redis uses fakeredis unless --redis-url is given
+
+colors = ["red", "blue", "green", "yellow", "orange", "purple", "black", "white"]
+symbols = ["==", "<", ">", "<=", ">="]
+
+def project_xml(index, categories=8, rules=4, parameters=1, rng=random):
+    # a project in the form parse_project reads
+    elements = []
+    for c in range(categories):
+        elements.append('<category name="category{}" color="{}" rough_amount="{}" rough_order="{}"/>'.format(c,
+                                                                                                             rng.choice(colors),
+                                                                                                             rng.randint(1, 100),
+                                                                                                             c))
+    for r in range(rules):
+        params = "".join('<parameter symbol={} values="{}"/>'.format(quoteattr(rng.choice(symbols)), rng.randint(0, 10)) for _ in range(parameters))
+        elements.append('<rule source="category{}" destination="dest{}" result="result{}">{}</rule>'.format(r % max(categories, 1), r, r, params))
+    return '<project name="project{}" width="{:.1f}" height="{:.1f}" depth="{:.1f}">{}</project>'.format(index,
+                                                                                                        rng.uniform(1, 12),
+                                                                                                        rng.uniform(1, 12),
+                                                                                                        rng.uniform(0.1, 3),
+                                                                                                        "".join(elements))
+
+def generate(count, seed=0, **kwargs):
+    rng = random.Random(seed)
+    return [project_xml(index, rng=rng, **kwargs) for index in range(count)]
+
+def timed(function, repeat=1):
+    # best of repeat, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_load(xmls, repeat):
+    def cold():
+        parse_cache.clear()
+        wipset = WipSet()
+        for xml in xmls:
+            wipset.add(xml)
+    def warm():
+        wipset = WipSet()
+        for xml in xmls:
+            wipset.add(xml)
+    parse_cache.max_entries = max(parse_cache.max_entries, len(xmls))
+    return {"load_project_xml" : timed(cold, repeat),
+            "load_project_xml_cached" : timed(warm, repeat)}
+
+def bench_sync(xmls, repeat, redis_url=None, batch_size=500):
+    import redis
+    from qma_sync import ProjectSync
+    if redis_url:
+        redis_conn = redis.StrictRedis.from_url(redis_url, decode_responses=True)
+    else:
+        import fakeredis
+        redis_conn = fakeredis.FakeStrictRedis(decode_responses=True)
+    prefix = "bench:project:"
+    for start in range(0, len(xmls), batch_size):
+        redis_conn.mset({"{}{}".format(prefix, index) : xml for index, xml in enumerate(xmls[start:start + batch_size], start)})
+    results = {}
+    try:
+        syncs = []
+        def full():
+            parse_cache.clear()
+            sync = ProjectSync(redis_conn, WipSet(), pattern=prefix + "*", batch_size=batch_size)
+            sync.reconcile()
+            syncs.append(sync)
+        results["reconcile"] = timed(full, repeat)
+        # nothing changed, only digests are compared
+        results["reconcile_unchanged"] = timed(syncs[-1].reconcile, repeat)
+    finally:
+        keys = list(redis_conn.scan_iter(prefix + "*", count=batch_size))
+        for start in range(0, len(keys), batch_size):
+            redis_conn.delete(*keys[start:start + batch_size])
+    return results
+
+def bench_queue(wipset, setsets, repeat):
+    rng = random.Random(1)
+    for wip in wipset.wips.values():
+        wip.queue_position = rng.randint(-10, 10)
+    queue = WipQueue()
+    def reset():
+        queue.reset((xml_hash, wip.queue_position) for xml_hash, wip in wipset.wips.items())
+    def index_setsets():
+        index = wipset.index
+        index.setsets.clear()
+        index.matches.clear()
+        index.set_setsets({id(setset) : compile_setset(setset) for setset in setsets})
+    return {"queue_reset" : timed(reset, repeat),
+            "setsets_index" : timed(index_setsets, repeat),
+            "setsets_columns" : timed(lambda: evaluate_setsets(setsets, wipset.wips.values()), repeat)}
+
+def bench_conditions(wipset, repeat):
+    import conditionling
+    dsl_string = "width > 5.0 in\n4.0 in < height < 50.0 in"
+    environments = [project_environment(wip.project) for wip in wipset.wips.values()]
+    conditionling.compile_conditions.cache_clear()
+    def evaluate():
+        for environment in environments:
+            conditionling.evaluate_conditions(dsl_string, environment)
+    return {"evaluate_conditions" : timed(evaluate, repeat)}
+
+def bench_render(wipset, limit, repeat):
+    from qma_render import VIEWS, render
+    wips = list(wipset.wips.values())[:limit]
+    results = {}
+    for view, (kind, width, height, options) in VIEWS.items():
+        def render_all():
+            for wip in wips:
+                render(wip.project, kind, width, height, **options)
+        results["render_" + view] = timed(render_all, repeat)
+    return results, len(wips)
+
+def run(sizes, repeat=3, categories=8, rules=4, parameters=1, render_limit=100, redis_url=None, skip=()):
+    setsets = [SetSet(attribute="zoom", value="5", conditions=["width < 4 in", "height > 3 in"]),
+               SetSet(attribute="zoom", value="2", conditions=["2 in < depth < 3 in"])]
+    # the grammar is loaded once per process, keep it out of the timings
+    for setset in setsets:
+        compile_setset(setset)
+    results = []
+    for size in sizes:
+        xmls = generate(size, categories=categories, rules=rules, parameters=parameters)
+        timings = {}
+        if "load" not in skip:
+            timings.update(bench_load(xmls, repeat))
+        if "sync" not in skip:
+            timings.update(bench_sync(xmls, repeat, redis_url))
+        wipset = WipSet()
+        for xml in xmls:
+            wipset.add(xml)
+        if "queue" not in skip:
+            timings.update(bench_queue(wipset, setsets, repeat))
+        if "conditions" not in skip:
+            timings.update(bench_conditions(wipset, repeat))
+        for name, seconds in timings.items():
+            results.append({"benchmark" : name, "projects" : size, "seconds" : seconds, "per_project" : seconds / size})
+        if "render" not in skip:
+            render_timings, rendered = bench_render(wipset, render_limit, repeat)
+            for name, seconds in render_timings.items():
+                results.append({"benchmark" : name, "projects" : rendered, "seconds" : seconds, "per_project" : seconds / max(rendered, 1)})
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes",
+                        nargs='+',
+                        type=int,
+                        default=[10, 1000, 10000],
+                        help="numbers of projects to time")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=3,
+                        help="runs per timing, the fastest is reported")
+    parser.add_argument("--categories", type=int, default=8, help="categories per project")
+    parser.add_argument("--rules", type=int, default=4, help="rules per project")
+    parser.add_argument("--parameters", type=int, default=1, help="parameters per rule")
+    parser.add_argument("--render-limit",
+                        type=int,
+                        default=100,
+                        help="projects rendered per size, rendering is slow")
+    parser.add_argument("--redis-url",
+                        default=None,
+                        help="use a redis server, for example redis://localhost:6379/15, instead of fakeredis")
+    parser.add_argument("--skip",
+                        nargs='+',
+                        default=[],
+                        choices=["load", "sync", "queue", "conditions", "render"])
+    parser.add_argument("--output",
+                        default=None,
+                        help="write json here instead of stdout")
+    args = parser.parse_args(argv)
+    report = {"python" : platform.python_version(),
+              "platform" : platform.platform(),
+              "time" : time.time(),
+              "parameters" : {"categories" : args.categories, "rules" : args.rules, "parameters" : args.parameters, "repeat" : args.repeat},
+              "results" : run(args.sizes,
+                              repeat=args.repeat,
+                              categories=args.categories,
+                              rules=args.rules,
+                              parameters=args.parameters,
+                              render_limit=args.render_limit,
+                              redis_url=args.redis_url,
+                              skip=args.skip)}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import os
+import sys
+import argparse
+from qma_core import QueueCore, SetSet, connections, configure_backend
+
+# queue maintenance without a display, for example
+#   python3 qma_cli.py list
+#   python3 qma_cli.py move 3fa2 -1
+#   python3 qma_cli.py prerender --no-redis --project-file *.xml
+
+def ingest(core, args):
+    print("{} wips".format(core.ingest(files=args.project_file)))
+    core.save()
+
+def list_queue(core, args):
+    core.ingest(files=args.project_file)
+    for xml_hash in core.queue():
+        wip = core.wips.wips[xml_hash]
+        print("{:>5} {} {}".format(wip.queue_position, xml_hash, wip.project.get("name", "")))
+
+def move(core, args):
+    core.ingest(files=args.project_file)
+    try:
+        wip = core.move(args.xml_hash, args.position)
+    except KeyError as ex:
+        print(ex.args[0])
+        return 1
+    print("{} -> {}".format(wip.xml_str_hash, wip.queue_position))
+
+def setsets(core, args):
+    core.ingest(files=args.project_file)
+    settings = [setting for setting in core.settings(args.settings_file) if isinstance(setting, SetSet)]
+    for setset, matches in core.evaluate_setsets(settings):
+        print("{}={} {} {}".format(setset.attribute, setset.value, setset.conditions, len(matches)))
+        if args.verbose:
+            for xml_hash in sorted(matches):
+                print("    {}".format(xml_hash))
+
+def prerender(core, args):
+    from qma_render import RenderCache, RedisTier
+    shared = None
+    binary_r = connections()[0]
+    if args.shared_render_cache and binary_r is not None:
+        shared = RedisTier(binary_r)
+    render_cache = RenderCache(args.render_cache_dir, shared=shared, disk_bytes=args.disk_cache_mb * 1024 * 1024)
+    farm = None
+    if args.workers != 1:
+        from qma_farm import RenderFarm
+        farm = RenderFarm(render_cache, workers=args.workers or None)
+        farm.start()
+    core.ingest(files=args.project_file)
+    try:
+        core.prerender(render_cache, farm)
+    finally:
+        if farm is not None:
+            farm.stop()
+    print("{} wips rendered".format(len(core.wips.wips)))
+
+def main(argv=None):
+    # options shared by every command, given after the command name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--project-file",
+                        nargs='+',
+                        default=[],
+                        help="project file(s) in xml")
+    common.add_argument("--no-redis",
+                        action="store_true",
+                        help="only use --project-file, positions are not saved")
+    common.add_argument("--redis-node",
+                        nargs='+',
+                        default=None,
+                        help="redis nodes as host:port/db, default is the ma service connection")
+    common.add_argument("--redis-cluster",
+                        action="store_true",
+                        help="--redis-node are startup nodes of a redis cluster")
+    common.add_argument("--batch-size",
+                        type=int,
+                        default=500,
+                        help="keys fetched per redis round trip")
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    command = commands.add_parser("ingest", parents=[common], help="load projects and save positions of new ones")
+    command.set_defaults(run=ingest)
+    command = commands.add_parser("list", parents=[common], help="print the queue in order")
+    command.set_defaults(run=list_queue)
+    command = commands.add_parser("move", parents=[common], help="set the queue position of a wip")
+    command.add_argument("xml_hash", help="xml hash or a unique prefix of one")
+    command.add_argument("position", type=int)
+    command.set_defaults(run=move)
+    command = commands.add_parser("setsets", parents=[common], help="count the wips each setset matches")
+    command.add_argument("--settings-file",
+                         default="default.xml",
+                         help="used when no settings are saved in redis")
+    command.add_argument("-v", "--verbose",
+                         action="store_true",
+                         help="print matching xml hashes")
+    command.set_defaults(run=setsets)
+    command = commands.add_parser("prerender", parents=[common], help="fill the render caches")
+    command.add_argument("--render-cache-dir",
+                         default=os.path.expanduser("~/.cache/qma-ui/renders"),
+                         help="directory for encoded project images")
+    command.add_argument("--shared-render-cache",
+                         action="store_true",
+                         help="also fill the redis render cache")
+    command.add_argument("--disk-cache-mb",
+                         type=int,
+                         default=1024,
+                         help="size the render cache directory is pruned to")
+    command.add_argument("--workers",
+                         type=int,
+                         default=0,
+                         help="render processes, 0 for one per core, 1 renders in this process")
+    command.set_defaults(run=prerender)
+    args = parser.parse_args(argv)
+
+    redis_conn = None
+    shards = []
+    cluster = False
+    if not args.no_redis:
+        backend = configure_backend(args.redis_node, cluster=args.redis_cluster)
+        redis_conn = backend.decoded
+        shards = backend.shards()
+        cluster = backend.cluster is not None
+    core = QueueCore(redis_conn, batch_size=args.batch_size, shards=shards, cluster=cluster)
+    return args.run(core, args)
+
+if __name__ == "__main__":
+    sys.exit(main())
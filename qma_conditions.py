@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import numpy
+import conditionling
+
+def project_environment(project):
+    # numeric values a condition can refer to: project attributes
+    # that parse as numbers and the rough_amount of each category
+    environment = {}
+    for name, value in project.items():
+        if isinstance(value, dict):
+            continue
+        try:
+            environment[name] = float(value)
+        except (TypeError, ValueError):
+            pass
+    for name, amount in project.get("categories", {}).items():
+        environment.setdefault(name, float(amount))
+    return environment
+
+def compile_setset(setset):
+    # every condition string of a setset must hold, None if
+    # there are none or they do not parse
+    conditions = [condition.strip() for condition in setset.conditions if condition and condition.strip()]
+    if not conditions:
+        return None
+    try:
+        return conditionling.compile_conditions("\n".join(conditions))
+    except Exception as ex:
+        print("could not compile {}: {}".format(conditions, ex))
+        return None
+
+class WipColumns(object):
+    # columnar float arrays over a list of wips, missing values are nan
+    def __init__(self, wips):
+        self.hashes = [wip.xml_str_hash for wip in wips]
+        environments = [project_environment(wip.project) for wip in wips]
+        names = set()
+        for environment in environments:
+            names.update(environment)
+        self.columns = {}
+        for name in names:
+            self.columns[name] = numpy.fromiter((environment.get(name, numpy.nan) for environment in environments),
+                                                dtype=numpy.float64,
+                                                count=len(environments))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def evaluate(self, compiled):
+        # boolean mask of the wips that satisfy compiled conditions
+        if compiled is None or not compiled.conditions:
+            return numpy.zeros(len(self), dtype=bool)
+        mask = numpy.ones(len(self), dtype=bool)
+        for condition in compiled.conditions:
+            column = self.columns.get(condition.field)
+            if column is None or not condition.checks:
+                return numpy.zeros(len(self), dtype=bool)
+            mask &= ~numpy.isnan(column)
+            for check in condition.checks:
+                if check.field_first:
+                    mask &= check.compare(column, check.value)
+                else:
+                    mask &= check.compare(check.value, column)
+        return mask
+
+    def matching(self, mask):
+        return {self.hashes[index] for index in numpy.flatnonzero(mask)}
+
+def evaluate_setsets(setsets, wips):
+    # one mask per setset, in the order given
+    columns = WipColumns(list(wips))
+    return columns, [columns.evaluate(compile_setset(setset)) for setset in setsets]
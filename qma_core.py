@@ -0,0 +1,413 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import hashlib
+import sys
+import attr
+import redis
+from qma_parse import parse_cache
+from qma_index import ConditionIndex
+from qma_queue import WipQueue
+from qma_store import QueueStore
+from qma_conditions import compile_setset
+from qma_metrics import metrics
+from qma_procs import CallSupervisor
+from qma_xmlstore import MemoryXmlStore
+
+# the queue without kivy, used by qma_ui and qma_cli. parsing
+# (lxml, ma_wip) and condition evaluation (numpy) are needed by
+# every WipSet and imported with this module, colour, settings
+# files and the redis backend the first time they are used
+
+_backend = None
+
+# Call actions started without a supervisor of their own
+default_supervisor = CallSupervisor()
+
+def configure_backend(nodes=None, cluster=False, timeout=5):
+    # nodes as "host:port/db" strings, None for the ma service connection
+    global _backend
+    from qma_backend import RedisBackend, parse_node
+    _backend = RedisBackend(None if not nodes else [parse_node(node) for node in nodes], cluster=cluster, timeout=timeout)
+    return _backend
+
+def backend():
+    if _backend is None:
+        configure_backend()
+    return _backend
+
+def connections():
+    # (binary, decoded) redis connections, None if there is no service
+    return backend().binary, backend().decoded
+
+def pick_color(obj):
+    import colour
+    return colour.Color(pick_for=obj)
+
+@attr.s
+class Call(object):
+    value = attr.ib(default="")
+    args = attr.ib(default=attr.Factory(list))
+    color = attr.ib(default=None)
+
+    @color.validator
+    def check(self, attribute, value):
+        if value is None:
+            setattr(self,'color', pick_color(self))
+
+    def action(self, supervisor=None, xml_hash=None):
+        # xml_hash is the project the call was made for, a call
+        # already running for it is focused instead of started again
+        if supervisor is None:
+            supervisor = default_supervisor
+        return supervisor.start(self, xml_hash)
+
+@attr.s
+class SetSet(object):
+    value = attr.ib(default="")
+    attribute = attr.ib(default="")
+    conditions = attr.ib(default=attr.Factory(list))
+    color = attr.ib(default=None)
+
+    @color.validator
+    def check(self, attribute, value):
+        if value is None:
+            setattr(self,'color', pick_color(self))
+
+def setting_to_dict(item):
+    if isinstance(item, Call):
+        return {"type" : "call", "value" : item.value, "args" : list(item.args), "color" : item.color.hex_l}
+    return {"type" : "setset",
+            "value" : item.value,
+            "attribute" : item.attribute,
+            "conditions" : list(item.conditions),
+            "color" : item.color.hex_l}
+
+def setting_from_dict(setting):
+    import colour
+    color = colour.Color(setting["color"])
+    if setting["type"] == "call":
+        return Call(value=setting["value"], args=setting["args"], color=color)
+    return SetSet(value=setting["value"], attribute=setting["attribute"], conditions=setting["conditions"], color=color)
+
+# default.xml comparator names
+comparator_symbols = {
+    "less than" : "<",
+    "less than or equal to" : "<=",
+    "equal to" : "=",
+    "greater than or equal to" : ">=",
+    "greater than" : ">",
+}
+
+def load_settings(file):
+    # Call and SetSet items from a defaults file such as default.xml
+    from lxml import etree
+    settings = []
+    try:
+        xml = etree.parse(file)
+    except OSError:
+        return settings
+    for default in xml.xpath('//default'):
+        default_type = str(default.xpath("./@type")[0])
+        if default_type == "call":
+            obj = Call(value=str(default.xpath("./@value")[0]))
+            for param in default.xpath('./parameter'):
+                if str(param.xpath("./@type")[0]) == "arg":
+                    obj.args.append(str(param.xpath("./@value")[0]))
+            settings.append(obj)
+        elif default_type == "setset":
+            obj = SetSet(attribute=str(default.xpath("./@attribute")[0]), value=str(default.xpath("./@value")[0]))
+            for param in default.xpath('./parameter'):
+                if str(param.xpath("./@type")[0]) == "condition":
+                    # written as conditionling, for example "width < 4 in"
+                    obj.conditions.append("{} {} {} in".format(param.get("attribute"),
+                                                               comparator_symbols.get(param.get("comparator"), param.get("comparator")),
+                                                               param.get("value").strip()))
+            settings.append(obj)
+    return settings
+
+@attr.s
+class WipSet(object):
+    wips = attr.ib(default=attr.Factory(dict))
+    # source (redis key or filename) -> xml hash
+    sources = attr.ib(default=attr.Factory(dict))
+    # xml hash -> number of sources holding it
+    source_counts = attr.ib(default=attr.Factory(collections.Counter), repr=False)
+    index = attr.ib(default=attr.Factory(ConditionIndex), repr=False)
+    # xml text by hash, see qma_xmlstore
+    xml_store = attr.ib(default=attr.Factory(MemoryXmlStore), repr=False)
+
+    @metrics.timed("wipset_add")
+    def add(self, xml, source=None):
+        # returns True if the set changed
+        xml_hash =  hashlib.sha224(xml.encode()).hexdigest()
+        try:
+            wip = self.wips[xml_hash]
+        except KeyError:
+            wip = self.load_project_xml(xml, xml_hash)
+        return self.put(wip, source)
+
+    def put(self, wip, source=None):
+        # adds an already loaded wip, see qma_ingest
+        xml_hash = wip.xml_str_hash
+        existing = self.wips.get(xml_hash)
+        changed = existing is None
+        if changed:
+            self.wips[xml_hash] = wip
+            self.index.add(xml_hash, wip.project)
+        elif existing is not wip:
+            # loaded again while held, the set keeps one store reference
+            self.xml_store.discard(xml_hash)
+        if source is not None:
+            previous = self.sources.get(source)
+            if previous != xml_hash:
+                self.sources[source] = xml_hash
+                self.source_counts[xml_hash] += 1
+                if previous is not None:
+                    self.source_counts[previous] -= 1
+                    self.discard(previous)
+                    changed = True
+        return changed
+
+    def remove(self, source):
+        try:
+            xml_hash = self.sources.pop(source)
+        except KeyError:
+            return False
+        self.source_counts[xml_hash] -= 1
+        self.discard(xml_hash)
+        return True
+
+    def discard(self, xml_hash):
+        # identical xml may be loaded from more than one source
+        if self.source_counts[xml_hash] <= 0:
+            del self.source_counts[xml_hash]
+            self.wips.pop(xml_hash, None)
+            self.index.remove(xml_hash)
+            self.xml_store.discard(xml_hash)
+
+    def load_project_xml(self, xml, xml_hash=None):
+        if xml_hash is None:
+            xml_hash = hashlib.sha224(xml.encode()).hexdigest()
+        self.xml_store.put(xml_hash, xml)
+        # the cache keeps the compact record, not the ParsedProject
+        return Wip.from_record(xml_hash, parse_cache.parse(xml, xml_hash, record=Wip.record), self.xml_store)
+
+def intern(value):
+    # category names, colours and attribute names repeat across
+    # thousands of projects, keep one copy of each
+    return sys.intern(value) if isinstance(value, str) else value
+
+@attr.s(slots=True)
+class WipCategory(object):
+    name = attr.ib(default="", converter=intern)
+    color = attr.ib(default="", converter=intern)
+    rough_amount = attr.ib(default=0)
+    rough_order = attr.ib(default=0)
+    rough_amount_start = attr.ib(default=None)
+    rough_amount_end = attr.ib(default=None)
+
+    def category(self):
+        from ma_wip.ling_classes import Category
+        c = Category(name=self.name, color=self.color, rough_amount=self.rough_amount, rough_order=self.rough_order)
+        if self.rough_amount_start is not None:
+            c.rough_amount_start = self.rough_amount_start
+        if self.rough_amount_end is not None:
+            c.rough_amount_end = self.rough_amount_end
+        return c
+
+@attr.s(slots=True)
+class WipRule(object):
+    source_field = attr.ib(default="", converter=intern)
+    dest_field = attr.ib(default="", converter=intern)
+    rule_result = attr.ib(default="", converter=intern)
+    comparator_symbol = attr.ib(default=None, converter=intern)
+    comparator_params = attr.ib(default=())
+
+    def rule(self):
+        from ma_wip.ling_classes import Rule
+        r = Rule()
+        r.source_field = self.source_field
+        r.dest_field = self.dest_field
+        r.rule_result = self.rule_result
+        if self.comparator_symbol is not None:
+            r.comparator_symbol = self.comparator_symbol
+            r.comparator_params = list(self.comparator_params)
+        return r
+
+@attr.s(slots=True)
+class Wip(object):
+    # the parsed project as tuples of interned values, project,
+    # rules, categories and xml_str are derived when asked for
+    xml_str_hash = attr.ib(default="")
+    queue_position = attr.ib(default=0)
+    # (name, value) of each project attribute
+    attributes = attr.ib(default=(), repr=False)
+    wip_categories = attr.ib(default=(), repr=False)
+    wip_rules = attr.ib(default=(), repr=False)
+    xml_store = attr.ib(default=None, repr=False)
+
+    @staticmethod
+    def record(parsed):
+        # (attributes, categories, rules) of a ParsedProject, shared
+        # by every Wip of the same xml and never changed
+        derived = ("categories", "palette", "order")
+        return (tuple((intern(name), intern(value)) for name, value in parsed.project.items() if name not in derived),
+                tuple(WipCategory(name=c.name,
+                                  color=c.color,
+                                  rough_amount=c.rough_amount,
+                                  rough_order=c.rough_order,
+                                  rough_amount_start=getattr(c, "rough_amount_start", None),
+                                  rough_amount_end=getattr(c, "rough_amount_end", None))
+                      for c in parsed.categories),
+                tuple(WipRule(source_field=r.source_field,
+                              dest_field=r.dest_field,
+                              rule_result=r.rule_result,
+                              comparator_symbol=getattr(r, "comparator_symbol", None),
+                              comparator_params=tuple(getattr(r, "comparator_params", None) or ()))
+                      for r in parsed.rules))
+
+    @classmethod
+    def from_record(cls, xml_hash, record, xml_store=None):
+        attributes, wip_categories, wip_rules = record
+        return cls(xml_str_hash=xml_hash,
+                   attributes=attributes,
+                   wip_categories=wip_categories,
+                   wip_rules=wip_rules,
+                   xml_store=xml_store)
+
+    @classmethod
+    def from_parsed(cls, xml_hash, parsed, xml_store=None):
+        return cls.from_record(xml_hash, cls.record(parsed), xml_store)
+
+    @property
+    def project(self):
+        # same layout as qma_parse.parse_project
+        project = {"categories" : {}, "palette" : {}, "order" : {}}
+        project.update(self.attributes)
+        for c in self.wip_categories:
+            project["categories"][c.name] = c.rough_amount
+            project["palette"][c.name] = {"fill" : c.color}
+            project["order"][c.name] = c.rough_order
+        return project
+
+    @property
+    def categories(self):
+        return [c.category() for c in self.wip_categories]
+
+    @property
+    def rules(self):
+        return [r.rule() for r in self.wip_rules]
+
+    @property
+    def xml_str(self):
+        if self.xml_store is None:
+            return None
+        return self.xml_store.get(self.xml_str_hash)
+
+    def activate(self):
+        pass
+
+    def deactivate(self):
+        pass
+
+class QueueCore(object):
+    # loading, ordering and setset evaluation for scripts and batch jobs.
+    # with a redis connection positions and settings are shared with
+    # running qma_ui instances through a QueueStore
+    def __init__(self, redis_conn=None, pattern="project:*", batch_size=500, shards=None, cluster=False):
+        # shards are (name, connection) holding projects, by default
+        # redis_conn. cluster is set when they are cluster primaries
+        self.redis_conn = redis_conn
+        self.shards = shards if shards is not None else ([("", redis_conn)] if redis_conn is not None else [])
+        self.cluster = cluster
+        self.pattern = pattern
+        self.batch_size = batch_size
+        self.wips = WipSet()
+        self.store = None
+        self.positions = {}
+        self.stored_settings = []
+        if redis_conn is not None:
+            self.store = QueueStore(redis_conn)
+            self.positions, self.stored_settings = self.store.restore()
+
+    def ingest(self, files=(), prepare=None):
+        # loads files and, with a connection, every project key.
+        # returns the number of wips loaded
+        from qma_ingest import WipFeed, IngestWorker
+        from qma_sync import project_sync
+        feed = WipFeed(self.wips.load_project_xml, prepare=prepare)
+        IngestWorker(feed, files=files).load_files()
+        sync = project_sync(self.shards, feed, pattern=self.pattern, batch_size=self.batch_size, cluster=self.cluster)
+        if sync is not None:
+            try:
+                sync.reconcile()
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as ex:
+                print("redis unavailable, projects there skipped: {}".format(ex))
+            sync.unsubscribe()
+        for action, source, wip in feed.drain():
+            if action == "add":
+                self.wips.put(wip, source)
+            else:
+                self.wips.remove(source)
+        for xml_hash, wip in self.wips.wips.items():
+            wip.queue_position = self.positions.get(xml_hash, wip.queue_position)
+        return len(self.wips.wips)
+
+    def save(self):
+        # writes positions of newly seen wips
+        if self.store is None:
+            return
+        for xml_hash, wip in self.wips.wips.items():
+            if xml_hash not in self.positions:
+                self.store.set_position(xml_hash, wip.queue_position)
+                self.positions[xml_hash] = wip.queue_position
+        self.store.flush()
+
+    def queue(self):
+        queue = WipQueue()
+        queue.reset((xml_hash, wip.queue_position) for xml_hash, wip in self.wips.wips.items())
+        return queue
+
+    def find(self, prefix):
+        # a wip by xml hash or an unambiguous prefix of one
+        found = [xml_hash for xml_hash in self.wips.wips if xml_hash.startswith(prefix)]
+        if len(found) != 1:
+            raise KeyError("{} matches {} wips".format(prefix, len(found)))
+        return self.wips.wips[found[0]]
+
+    def move(self, prefix, position):
+        wip = self.find(prefix)
+        wip.queue_position = position
+        self.positions[wip.xml_str_hash] = position
+        if self.store is not None:
+            self.store.set_position(wip.xml_str_hash, position)
+            self.store.flush()
+        return wip
+
+    def settings(self, default_file="default.xml"):
+        if self.stored_settings:
+            return [setting_from_dict(setting) for setting in self.stored_settings]
+        return load_settings(default_file)
+
+    def evaluate_setsets(self, setsets):
+        # (setset, matching xml hashes) for each setset
+        index = self.wips.index
+        index.set_setsets({id(setset) : compile_setset(setset) for setset in setsets})
+        return [(setset, index.matches[id(setset)]) for setset in setsets]
+
+    def prerender(self, render_cache, farm=None):
+        # with a RenderFarm views are rendered in parallel, head of the queue first
+        if farm is None:
+            for wip in self.wips.wips.values():
+                render_cache.prepare(wip)
+            return
+        from qma_render import VIEWS
+        for index, xml_hash in enumerate(self.queue()):
+            for view in VIEWS:
+                farm.request(self.wips.wips[xml_hash], view, priority=index)
+        farm.join()
@@ -0,0 +1,169 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from qma_render import VIEWS, RawImage, render_image
+from qma_metrics import metrics
+
+# priority of renders nobody is waiting for, such as new wips
+BACKGROUND = 1 << 20
+
+def render_job(project, kind, width, height, options):
+    # runs in a pool process, returns (RawImage, encoded bytes)
+    return render_image(project, kind, width, height, **options)
+
+def pool_context():
+    # the fork server is a fresh process that imports this module and
+    # the main script, workers are forked from it. qma_ui.py keeps
+    # kivy out of its module level so neither loads it
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["qma_farm"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+class RenderFarm(object):
+    # renders views of wips in a pool of processes, lowest priority
+    # number first. a view already waiting or rendering is not queued
+    # twice, asking again with a lower number moves it forward.
+    # results go into the encoded tiers of render_cache and to
+    # callback(wip, view, RawImage), called on a farm thread.
+    # a view that failed is not rendered again until retry_delay
+    # seconds have passed, doubling with each further failure
+    def __init__(self, render_cache, workers=None, retry_delay=5, max_retry_delay=600):
+        self.render_cache = render_cache
+        self.workers = workers or os.cpu_count() or 1
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # key -> (failures, monotonic time to retry at)
+        self.failures = {}
+        self.executor = None
+        # (priority, order, key), entries whose priority changed are skipped
+        self.heap = []
+        self.order = itertools.count()
+        # key -> [priority, wip, view, callbacks]
+        self.waiting = {}
+        self.running = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def start(self):
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context())
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+    def request(self, wip, view, priority=0, callback=None):
+        key = self.render_cache.view_key(wip, view)
+        with self.condition:
+            failure = self.failures.get(key)
+            if failure is not None and time.monotonic() < failure[1]:
+                return
+            entry = self.running.get(key) or self.waiting.get(key)
+            if entry is None:
+                entry = self.waiting[key] = [priority, wip, view, []]
+                heapq.heappush(self.heap, (priority, next(self.order), key))
+            elif key in self.waiting and priority < entry[0]:
+                entry[0] = priority
+                heapq.heappush(self.heap, (priority, next(self.order), key))
+            if callback is not None and callback not in entry[3]:
+                entry[3].append(callback)
+            self.condition.notify_all()
+
+    def dispatch(self):
+        # keeps every worker busy with one job queued behind it, so a
+        # newly urgent view waits for at most one render per worker
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.heap or len(self.running) >= self.workers * 2):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                priority, _, key = heapq.heappop(self.heap)
+                entry = self.waiting.get(key)
+                if entry is None or entry[0] != priority:
+                    continue
+                del self.waiting[key]
+                self.running[key] = entry
+            self.start_job(key, entry)
+
+    def start_job(self, key, entry):
+        priority, wip, view, callbacks = entry
+        data = self.render_cache.lookup(key)
+        if data is not None:
+            self.finish(key, data, None)
+            return
+        kind, width, height, options = VIEWS[view]
+        try:
+            future = self.executor.submit(render_job, wip.project, kind, width, height, options)
+        except BrokenProcessPool as ex:
+            # a worker died, later jobs go to a new pool
+            metrics.count("farm_failures")
+            print("render pool broken: {}".format(ex))
+            if not self.stopped:
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context())
+            self.finish(key, None, None)
+            return
+        except RuntimeError:
+            # shut down
+            self.finish(key, None, None)
+            return
+        metrics.count("farm_jobs")
+        future.add_done_callback(lambda future: self.rendered(key, future))
+
+    def rendered(self, key, future):
+        if future.cancelled():
+            self.finish(key, None, None)
+            return
+        try:
+            image, data = future.result()
+        except Exception as ex:
+            metrics.count("farm_failures")
+            print("could not render {}: {}".format(key, ex))
+            image, data = None, None
+        with self.condition:
+            if data is None:
+                count = self.failures.get(key, (0, 0))[0]
+                self.failures[key] = (count + 1, time.monotonic() + min(self.retry_delay * 2 ** count, self.max_retry_delay))
+            else:
+                self.failures.pop(key, None)
+        if data is not None:
+            self.render_cache.store(key, data)
+        self.finish(key, data, image)
+
+    def finish(self, key, data, image):
+        # a cached view is only decoded when someone is waiting for it
+        with self.condition:
+            priority, wip, view, callbacks = self.running.pop(key)
+            self.condition.notify_all()
+        if data is None or not callbacks:
+            return
+        if image is None:
+            image = RawImage.from_encoded(data)
+        for callback in callbacks:
+            callback(wip, view, image)
+
+    def pending(self):
+        with self.condition:
+            return len(self.waiting) + len(self.running)
+
+    def join(self):
+        # waits until everything requested so far is done
+        with self.condition:
+            while not self.stopped and (self.waiting or self.running):
+                self.condition.wait()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import time
+from kivy.clock import Clock
+from qma_metrics import metrics
+
+class FrameScheduler(object):
+    # ui work spread over frames, main thread only.
+    # refresh(callback) runs callback once in the coming frame however
+    # often it is asked for. add(key, callback) queues a smaller piece
+    # of work, a pending piece with the same key is replaced. pieces
+    # run in order after the refreshes until budget seconds of the
+    # frame are used, at least one per frame, the rest wait. other
+    # per frame work shares the budget through deadline()
+    def __init__(self, budget=0.008):
+        self.budget = budget
+        self.refreshes = collections.OrderedDict()
+        self.tasks = collections.OrderedDict()
+        self.trigger = Clock.create_trigger(self.run, 0)
+        self.frame = None
+        self.frame_deadline = 0
+
+    def deadline(self):
+        # perf_counter time this frame's budget runs out at, counted
+        # from the first call in the frame
+        if Clock.frames != self.frame:
+            self.frame = Clock.frames
+            self.frame_deadline = time.perf_counter() + self.budget
+        return self.frame_deadline
+
+    def refresh(self, callback):
+        self.refreshes[callback] = None
+        self.trigger()
+
+    def add(self, key, callback):
+        self.tasks.pop(key, None)
+        self.tasks[key] = callback
+        self.trigger()
+
+    def cancel(self, key):
+        self.tasks.pop(key, None)
+
+    def pending(self):
+        return len(self.refreshes) + len(self.tasks)
+
+    def run(self, dt=None):
+        start = time.perf_counter()
+        deadline = self.deadline()
+        refreshes, self.refreshes = self.refreshes, collections.OrderedDict()
+        for callback in refreshes:
+            callback()
+        while self.tasks:
+            key, callback = self.tasks.popitem(last=False)
+            callback()
+            if time.perf_counter() >= deadline:
+                break
+        metrics.observe("frame_work", time.perf_counter() - start)
+        if self.pending():
+            self.trigger()
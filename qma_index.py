@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+from sortedcontainers import SortedKeyList
+from qma_conditions import project_environment
+
+# symbol as seen from the field when the value is written first,
+# "4.0 in < height" is height > 4.0
+flipped_symbols = {"<" : ">", "<=" : ">=", ">" : "<", ">=" : "<=", "=" : "=", "==" : "==", "!=" : "!="}
+
+class ConditionIndex(object):
+    # sorted (value, xml hash) lists per numeric attribute so a
+    # condition is answered with range lookups, plus the cached set
+    # of matching wips for each registered setset. adding or removing
+    # a wip only evaluates the registered setsets against that wip
+    def __init__(self):
+        self.attributes = {}
+        self.environments = {}
+        self.setsets = {}
+        self.matches = {}
+
+    def add(self, xml_hash, project):
+        if xml_hash in self.environments:
+            return
+        environment = project_environment(project)
+        self.environments[xml_hash] = environment
+        for name, value in environment.items():
+            if name not in self.attributes:
+                self.attributes[name] = SortedKeyList(key=lambda entry: entry[0])
+            self.attributes[name].add((value, xml_hash))
+        for key, compiled in self.setsets.items():
+            if compiled is not None and compiled(environment):
+                self.matches[key].add(xml_hash)
+
+    def remove(self, xml_hash):
+        try:
+            environment = self.environments.pop(xml_hash)
+        except KeyError:
+            return
+        for name, value in environment.items():
+            self.attributes[name].discard((value, xml_hash))
+        for matched in self.matches.values():
+            matched.discard(xml_hash)
+
+    def field_range(self, field, symbol, value):
+        values = self.attributes.get(field)
+        if values is None:
+            return set()
+        if symbol == "<":
+            entries = values.irange_key(max_key=value, inclusive=(True, False))
+        elif symbol == "<=":
+            entries = values.irange_key(max_key=value)
+        elif symbol == ">":
+            entries = values.irange_key(min_key=value, inclusive=(False, True))
+        elif symbol == ">=":
+            entries = values.irange_key(min_key=value)
+        elif symbol in ("=", "=="):
+            entries = values.irange_key(value, value)
+        else:
+            return {xml_hash for entry_value, xml_hash in values if entry_value != value}
+        return {xml_hash for _, xml_hash in entries}
+
+    def query(self, compiled):
+        # xml hashes meeting every condition of compiled
+        if compiled is None or not compiled.conditions:
+            return set()
+        matched = None
+        for condition in compiled.conditions:
+            if not condition.checks:
+                return set()
+            for check in condition.checks:
+                symbol = check.symbol if check.field_first else flipped_symbols[check.symbol]
+                found = self.field_range(condition.field, symbol, check.value)
+                matched = found if matched is None else matched & found
+                if not matched:
+                    return set()
+        return matched
+
+    def set_setset(self, key, compiled):
+        # compiled conditions are cached by conditionling, so an
+        # unchanged setset keeps its match set without a lookup
+        if key in self.setsets and self.setsets[key] is compiled:
+            return
+        self.setsets[key] = compiled
+        self.matches[key] = self.query(compiled)
+
+    def remove_setset(self, key):
+        self.setsets.pop(key, None)
+        self.matches.pop(key, None)
+
+    def set_setsets(self, compiled_by_key):
+        for key in [key for key in self.setsets if key not in compiled_by_key]:
+            self.remove_setset(key)
+        for key, compiled in compiled_by_key.items():
+            self.set_setset(key, compiled)
@@ -0,0 +1,105 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import hashlib
+import queue
+import threading
+import time
+import redis
+from qma_metrics import metrics
+
+class WipFeed(object):
+    # stands in for a WipSet on the ingest thread: xml is parsed
+    # (and optionally prepared, for example prerendered) there and
+    # finished wips are handed to the ui thread through a queue
+    def __init__(self, load, prepare=None):
+        self.load = load
+        self.prepare = prepare
+        # source -> xml hash, as seen by the ingest thread
+        self.sources = {}
+        self.queue = queue.Queue()
+
+    def add(self, xml, source=None):
+        xml_hash = hashlib.sha224(xml.encode()).hexdigest()
+        if source is not None and self.sources.get(source) == xml_hash:
+            return False
+        try:
+            with metrics.timer("ingest_load"):
+                wip = self.load(xml, xml_hash)
+            if self.prepare is not None:
+                with metrics.timer("ingest_prepare"):
+                    self.prepare(wip)
+        except Exception as ex:
+            metrics.count("ingest_errors")
+            print("could not load {}: {}".format(source, ex))
+            return False
+        if source is not None:
+            self.sources[source] = xml_hash
+        self.queue.put(("add", source, wip))
+        return True
+
+    def remove(self, source):
+        try:
+            del self.sources[source]
+        except KeyError:
+            return False
+        self.queue.put(("remove", source, None))
+        return True
+
+    def drain(self):
+        while True:
+            try:
+                yield self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+class IngestWorker(threading.Thread):
+    # runs file loading and redis sync off the ui thread
+    def __init__(self, feed, sync=None, files=None, mode="notify", reconcile_interval=300, poll_interval=10, poll_timeout=0.25, retry_interval=5):
+        self.feed = feed
+        self.sync = sync
+        self.files = files or []
+        self.mode = mode
+        self.reconcile_interval = reconcile_interval
+        self.poll_interval = poll_interval
+        self.poll_timeout = poll_timeout
+        self.retry_interval = retry_interval
+        self.stopped = threading.Event()
+        super(IngestWorker, self).__init__(daemon=True)
+
+    def stop(self):
+        self.stopped.set()
+
+    def load_files(self):
+        for file in self.files:
+            try:
+                with open(file, "r") as f:
+                    self.feed.add(f.read(), source=file)
+            except OSError as ex:
+                print(ex)
+
+    def run(self):
+        self.load_files()
+        if self.sync is None:
+            return
+        last_reconcile = time.monotonic()
+        while not self.stopped.is_set():
+            if self.mode == "notify":
+                # without notifications reconciling is the only way to see changes
+                interval = self.reconcile_interval if self.sync.notifying else self.poll_interval
+                if time.monotonic() - last_reconcile > interval:
+                    self.sync.needs_reconcile = True
+                    last_reconcile = time.monotonic()
+                self.sync.poll(timeout=self.poll_timeout)
+                if self.sync.pubsub is None:
+                    self.stopped.wait(self.retry_interval)
+            else:
+                try:
+                    self.sync.reconcile()
+                except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+                    pass
+                self.stopped.wait(self.poll_interval)
+        self.sync.unsubscribe()
@@ -0,0 +1,150 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import os
+import time
+import threading
+import functools
+import contextlib
+import tempfile
+
+class Metrics(object):
+    # counters, timers and gauges shared by every thread. a timer
+    # keeps count, total and max seconds, gauges may be callables
+    # that are read when a snapshot is taken
+    def __init__(self, prefix="qma_"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        # name -> [count, total seconds, max seconds]
+        self.timers = {}
+        self.gauges = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            try:
+                timer = self.timers[name]
+            except KeyError:
+                timer = self.timers[name] = [0, 0.0, 0.0]
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        # flat name -> value, timers as _count, _seconds_sum and _seconds_max
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {name : list(timer) for name, timer in self.timers.items()}
+        values = {}
+        for name, value in counters.items():
+            values[name + "_total"] = value
+        for name, (count, total, longest) in timers.items():
+            values[name + "_count"] = count
+            values[name + "_seconds_sum"] = total
+            values[name + "_seconds_max"] = longest
+        for name, value in list(self.gauges.items()):
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+            values[name] = value
+        return values
+
+    def prometheus(self):
+        lines = []
+        for name, value in sorted(self.snapshot().items()):
+            lines.append("{}{} {}".format(self.prefix, name, float(value)))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        # written beside path and renamed, for the node exporter textfile collector
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, suffix=".tmp") as f:
+            f.write(self.prometheus())
+        os.replace(f.name, path)
+
+    def write_redis(self, redis_conn, key="qma:metrics"):
+        redis_conn.hset(key, mapping={name : value for name, value in self.snapshot().items()})
+
+metrics = Metrics()
+
+class MetricsExporter(threading.Thread):
+    # writes metrics every interval seconds off the ui thread
+    def __init__(self, metrics, textfile=None, redis_conn=None, redis_key="qma:metrics", interval=10):
+        self.metrics = metrics
+        self.textfile = textfile
+        self.redis_conn = redis_conn
+        self.redis_key = redis_key
+        self.interval = interval
+        self.stopped = threading.Event()
+        super(MetricsExporter, self).__init__(daemon=True)
+
+    def export(self):
+        try:
+            if self.textfile:
+                self.metrics.write_textfile(self.textfile)
+            if self.redis_conn is not None:
+                self.metrics.write_redis(self.redis_conn, self.redis_key)
+        except Exception as ex:
+            print("could not export metrics: {}".format(ex))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+        self.export()
+
+    def stop(self):
+        self.stopped.set()
+
+class Profiler(object):
+    # cProfile of the thread that calls toggle(), each
+    # capture is written to its own file in directory
+    def __init__(self, directory):
+        self.directory = directory
+        self.profile = None
+
+    def toggle(self):
+        import cProfile
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            return None
+        self.profile.disable()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "qma-{}.prof".format(time.strftime("%Y%m%d-%H%M%S")))
+        self.profile.dump_stats(path)
+        self.profile = None
+        print("profile written to {}".format(path))
+        return path
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import hashlib
+import threading
+import attr
+from lxml import etree
+from ma_wip.ling_classes import Rule, Category
+
+@attr.s
+class ParsedProject(object):
+    project = attr.ib(default=attr.Factory(dict))
+    rules = attr.ib(default=attr.Factory(list))
+    categories = attr.ib(default=attr.Factory(list))
+
+def parse_rule(rule):
+    r = Rule()
+    r.source_field = str(rule.attrib["source"])
+    r.dest_field = str(rule.attrib["destination"])
+    r.rule_result = str(rule.attrib["result"])
+    # does not handle multiple parameters
+    for parameter in rule.iter("parameter"):
+        r.comparator_symbol = str(parameter.attrib["symbol"])
+        r.comparator_params = [str(parameter.attrib["values"])]
+    return r
+
+def parse_category(category):
+    try:
+        rough_order = float(category.attrib["rough_order"])
+    except (KeyError, ValueError):
+        rough_order = 0
+    c = Category(name = str(category.attrib["name"]),
+                 color = str(category.attrib["color"]),
+                 rough_amount = int(category.attrib["rough_amount"]),
+                 rough_order = rough_order)
+    if "rough_amount_start" in category.attrib:
+        c.rough_amount_start = category.attrib["rough_amount_start"]
+    if "rough_amount_end" in category.attrib:
+        c.rough_amount_end = category.attrib["rough_amount_end"]
+    return c
+
+def parse_project(xml):
+    parsed = ParsedProject()
+    parsed.project['categories'] = {}
+    parsed.project['palette'] = {}
+    parsed.project['order'] = {}
+
+    root = etree.fromstring(xml)
+    for project in root.iter("project"):
+        parsed.project.update(project.attrib)
+        # rules and categories are read in one walk of the project,
+        # parameters only from the subtree of their own rule
+        for element in project.iter("rule", "category"):
+            if element.tag == "rule":
+                parsed.rules.append(parse_rule(element))
+            else:
+                c = parse_category(element)
+                parsed.categories.append(c)
+                parsed.project['categories'][c.name] = c.rough_amount
+                parsed.project['palette'][c.name] = {"fill" : c.color}
+                parsed.project['order'][c.name] = c.rough_order
+
+    return parsed
+
+class ParseCache(object):
+    # lru of parsed projects keyed by the sha224 of their xml,
+    # shared by the ui and ingest threads. record(parsed) picks what
+    # is kept, by default the ParsedProject itself, callers sharing
+    # the cache pass the same record
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, xml, xml_hash=None, record=None):
+        if xml_hash is None:
+            xml_hash = hashlib.sha224(xml.encode()).hexdigest()
+        with self.lock:
+            try:
+                parsed = self.entries[xml_hash]
+                self.entries.move_to_end(xml_hash)
+                self.hits += 1
+                return parsed
+            except KeyError:
+                self.misses += 1
+        # parse outside the lock, a duplicate parse on a race is harmless
+        parsed = parse_project(xml)
+        if record is not None:
+            parsed = record(parsed)
+        with self.lock:
+            self.entries[xml_hash] = parsed
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return parsed
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+parse_cache = ParseCache()
@@ -0,0 +1,144 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import os
+import shutil
+import subprocess
+import threading
+import time
+import attr
+from qma_metrics import metrics
+
+@attr.s
+class CallProcess(object):
+    command = attr.ib(default="")
+    args = attr.ib(default=attr.Factory(list))
+    xml_hash = attr.ib(default=None)
+    process = attr.ib(default=None, repr=False)
+    started = attr.ib(default=None)
+    ended = attr.ib(default=None)
+    returncode = attr.ib(default=None)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def running(self):
+        return self.ended is None
+
+    def runtime(self):
+        return (self.ended or time.time()) - self.started
+
+    def rss(self):
+        # resident memory in bytes, None once exited or without /proc
+        try:
+            with open("/proc/{}/status".format(self.pid)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def cpu_seconds(self):
+        try:
+            with open("/proc/{}/stat".format(self.pid)) as f:
+                # fields after the parenthesised name, utime and stime are 14 and 15
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+class CallSupervisor(object):
+    # starts Call actions as children that are waited on by a reaper
+    # thread. a command runs at most limits.get(command, default_limit)
+    # times at once, and a command already running for a project is
+    # focused instead of started again. exited calls are kept in
+    # finished, newest last
+    def __init__(self, limits=None, default_limit=1, history=50):
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.running = {}
+        self.finished = collections.deque(maxlen=history)
+        self.lock = threading.Lock()
+
+    def limit(self, command):
+        return self.limits.get(command, self.default_limit)
+
+    def find(self, command, xml_hash):
+        with self.lock:
+            for call_process in self.running.values():
+                if call_process.command == command and call_process.xml_hash == xml_hash:
+                    return call_process
+        return None
+
+    def start(self, call, xml_hash=None):
+        # returns the CallProcess started or reused, None if refused
+        existing = self.find(call.value, xml_hash)
+        if existing is not None:
+            metrics.count("calls_reused")
+            self.focus(existing)
+            return existing
+        args = [arg for arg in call.args if arg]
+        with self.lock:
+            running = sum(1 for call_process in self.running.values() if call_process.command == call.value)
+            if running >= self.limit(call.value):
+                metrics.count("calls_refused")
+                print("{} already running {} times".format(call.value, running))
+                return None
+            try:
+                process = subprocess.Popen([call.value, *args])
+            except OSError as ex:
+                print(call, ex)
+                return None
+            call_process = CallProcess(command=call.value,
+                                       args=args,
+                                       xml_hash=xml_hash,
+                                       process=process,
+                                       started=time.time())
+            self.running[process.pid] = call_process
+        metrics.count("calls_started")
+        threading.Thread(target=self.reap, args=(call_process,), daemon=True).start()
+        return call_process
+
+    def reap(self, call_process):
+        call_process.returncode = call_process.process.wait()
+        call_process.ended = time.time()
+        with self.lock:
+            self.running.pop(call_process.pid, None)
+            self.finished.append(call_process)
+
+    def focus(self, call_process):
+        # raises the window of a running call, if xdotool is installed
+        if shutil.which("xdotool") is None:
+            return False
+        try:
+            subprocess.run(["xdotool", "search", "--pid", str(call_process.pid), "windowactivate"],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL,
+                           timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return True
+
+    def stop(self, call_process):
+        try:
+            call_process.process.terminate()
+        except OSError:
+            pass
+
+    def stop_all(self):
+        for call_process in self.processes(finished=False):
+            self.stop(call_process)
+
+    def processes(self, finished=True):
+        with self.lock:
+            processes = list(self.running.values())
+            if finished:
+                processes.extend(reversed(self.finished))
+        return processes
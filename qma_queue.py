@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import itertools
+from sortedcontainers import SortedList
+
+class WipQueue(object):
+    # wips ordered by queue position, ties kept in arrival order.
+    # insert, remove, reposition, index and pop_active are O(log n).
+    #
+    # listeners bound with bind() are called as
+    #   listener(event, xml_hash, old_index, new_index)
+    # with event one of "insert", "remove", "move" or "reset"
+    # (reset has no xml_hash or indexes, everything may have changed)
+    def __init__(self):
+        self.entries = SortedList()
+        # xml hash -> (position, arrival)
+        self.keys = {}
+        self.arrivals = itertools.count()
+        self.listeners = []
+
+    def bind(self, listener):
+        self.listeners.append(listener)
+
+    def unbind(self, listener):
+        self.listeners.remove(listener)
+
+    def dispatch(self, event, xml_hash=None, old_index=None, new_index=None):
+        for listener in self.listeners:
+            listener(event, xml_hash, old_index, new_index)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, xml_hash):
+        return xml_hash in self.keys
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield entry[2]
+
+    def position(self, xml_hash):
+        return self.keys[xml_hash][0]
+
+    def index(self, xml_hash):
+        position, arrival = self.keys[xml_hash]
+        return self.entries.index((position, arrival, xml_hash))
+
+    def insert(self, xml_hash, position=0):
+        if xml_hash in self.keys:
+            return self.reposition(xml_hash, position)[1]
+        entry = (position, next(self.arrivals), xml_hash)
+        self.keys[xml_hash] = entry[:2]
+        self.entries.add(entry)
+        index = self.entries.index(entry)
+        self.dispatch("insert", xml_hash, None, index)
+        return index
+
+    def remove(self, xml_hash):
+        index = self.index(xml_hash)
+        del self.entries[index]
+        del self.keys[xml_hash]
+        self.dispatch("remove", xml_hash, index, None)
+        return index
+
+    def reposition(self, xml_hash, position):
+        # a moved wip keeps its arrival, so it sorts after wips that
+        # arrived before it at the new position
+        old_position, arrival = self.keys[xml_hash]
+        old_index = self.index(xml_hash)
+        if position == old_position:
+            return old_index, old_index
+        del self.entries[old_index]
+        entry = (position, arrival, xml_hash)
+        self.keys[xml_hash] = entry[:2]
+        self.entries.add(entry)
+        new_index = self.entries.index(entry)
+        self.dispatch("move", xml_hash, old_index, new_index)
+        return old_index, new_index
+
+    def head(self):
+        try:
+            return self.entries[0][2]
+        except IndexError:
+            return None
+
+    def pop_active(self):
+        xml_hash = self.head()
+        if xml_hash is not None:
+            self.remove(xml_hash)
+        return xml_hash
+
+    def range(self, start=0, count=None):
+        # xml hashes from index start, for example the next count after the head
+        stop = None if count is None else start + count
+        return [entry[2] for entry in self.entries.islice(start, stop)]
+
+    def reset(self, positions):
+        # replaces the whole queue from (xml hash, position) pairs,
+        # wips already queued keep their arrival
+        keys = {}
+        for xml_hash, position in positions:
+            try:
+                arrival = self.keys[xml_hash][1]
+            except KeyError:
+                arrival = next(self.arrivals)
+            keys[xml_hash] = (position, arrival)
+        self.keys = keys
+        self.entries = SortedList((position, arrival, xml_hash) for xml_hash, (position, arrival) in keys.items())
+        self.dispatch("reset")
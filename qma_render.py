@@ -0,0 +1,270 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import attr
+import redis
+from PIL import Image
+from qma_metrics import metrics
+
+# view name -> (visualization function name, width, height, options)
+VIEWS = {
+    "overview" : ("project_overview", 500, 200, {"orientation" : "horizontal", "color_key" : True, "background_color" : (50, 50, 50, 255)}),
+    "dimensions" : ("project_dimensions", 500, 150, {"scale" : 5, "background_color" : (50, 50, 50, 255)}),
+}
+
+@attr.s(slots=True)
+class RawImage(object):
+    # uncompressed pixels, rows top first, ready for a texture upload
+    width = attr.ib(default=0)
+    height = attr.ib(default=0)
+    mode = attr.ib(default="RGB")
+    pixels = attr.ib(default=b"", repr=False)
+
+    @classmethod
+    def from_pil(cls, image):
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        return cls(image.width, image.height, image.mode, image.tobytes())
+
+    @classmethod
+    def from_encoded(cls, data):
+        with metrics.timer("image_decode"):
+            return cls.from_pil(Image.open(io.BytesIO(data)))
+
+def render(project, kind, width, height, **options):
+    # returns encoded jpeg bytes
+    return render_image(project, kind, width, height, **options)[1]
+
+def render_image(project, kind, width, height, **options):
+    # returns (RawImage, encoded jpeg bytes). the visualizations
+    # return the image they drew along with its encoding, so the
+    # pixels are available without decoding the jpeg again
+    from ma_wip import visualizations
+    with metrics.timer("render"):
+        image, encoded = getattr(visualizations, kind)(project, width, height, **options)
+        return RawImage.from_pil(image), encoded.getvalue()
+
+def cache_key(xml_hash, kind, width, height, options):
+    options_hash = hashlib.sha1(repr(sorted(options.items())).encode()).hexdigest()[:12]
+    return "{}:{}:{}x{}:{}".format(xml_hash, kind, width, height, options_hash)
+
+class MemoryTier(object):
+    # lru holding at most max_bytes as counted by sizeof,
+    # evict(value) is called for every value dropped
+    def __init__(self, max_bytes, sizeof=len, evict=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.evict = evict
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+
+    def get(self, key):
+        try:
+            value, size = self.entries[key]
+        except KeyError:
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if key in self.entries:
+            self.dropped(*self.entries.pop(key))
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            self.dropped(*self.entries.popitem(last=False)[1])
+
+    def dropped(self, value, size):
+        self.bytes -= size
+        if self.evict is not None:
+            self.evict(value)
+
+    def clear(self):
+        while self.entries:
+            self.dropped(*self.entries.popitem()[1])
+
+class DiskTier(object):
+    # with max_bytes the directory is pruned back under it by the first
+    # put and again whenever an eighth of max_bytes has been written
+    def __init__(self, directory, extension=".jpg", max_bytes=None):
+        self.directory = directory
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.written = max_bytes or 0
+        self.pruning = threading.Lock()
+
+    def path(self, key):
+        name = key.replace(":", "_")
+        return os.path.join(self.directory, name[:2], name + self.extension)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename so readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as ex:
+            print(ex)
+            return
+        if self.max_bytes is None:
+            return
+        self.written += len(data)
+        # a put on another thread may already be pruning
+        if self.written >= self.max_bytes // 8 and self.pruning.acquire(blocking=False):
+            try:
+                self.written = 0
+                self.prune(self.max_bytes)
+            finally:
+                self.pruning.release()
+
+    def prune(self, max_bytes):
+        # drop least recently modified files until under max_bytes
+        files = []
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+class RedisTier(object):
+    # shared between qma-ui instances, expects a client without decode_responses
+    def __init__(self, redis_conn, prefix="qma:render:", ttl=7 * 24 * 60 * 60):
+        self.redis_conn = redis_conn
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        try:
+            return self.redis_conn.get(self.prefix + key)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            return None
+
+    def put(self, key, data):
+        try:
+            self.redis_conn.set(self.prefix + key, data, ex=self.ttl)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            pass
+
+class RenderCache(object):
+    # decoded images in memory, encoded images on disk and
+    # optionally in redis. decode(RawImage) makes the in memory value,
+    # fresh renders go to it without a trip through the jpeg.
+    # encoded() may be called from any thread, decoded() only from
+    # the thread that owns the decoded objects
+    def __init__(self, directory, shared=None, memory_bytes=128 * 1024 * 1024, decode=None, sizeof=len, evict=None, disk_bytes=None):
+        self.memory = MemoryTier(memory_bytes, sizeof, evict)
+        self.disk = DiskTier(directory, max_bytes=disk_bytes)
+        self.shared = shared
+        self.decode = decode
+
+    def lookup(self, key):
+        # encoded bytes from disk or the shared tier, None on a miss
+        data = self.disk.get(key)
+        if data is not None:
+            metrics.count("render_cache_disk_hits")
+            return data
+        if self.shared is not None:
+            data = self.shared.get(key)
+            if data is not None:
+                metrics.count("render_cache_shared_hits")
+                self.disk.put(key, data)
+                return data
+        metrics.count("render_cache_misses")
+        return None
+
+    def store(self, key, data):
+        self.disk.put(key, data)
+        if self.shared is not None:
+            self.shared.put(key, data)
+
+    def encoded(self, xml_hash, project, kind, width, height, **options):
+        # project may be a function returning the project dict,
+        # so it is only derived when there is something to render
+        key = cache_key(xml_hash, kind, width, height, options)
+        data = self.lookup(key)
+        if data is not None:
+            return data
+        if callable(project):
+            project = project()
+        data = render(project, kind, width, height, **options)
+        self.store(key, data)
+        return data
+
+    def view_encoded(self, wip, view):
+        kind, width, height, options = VIEWS[view]
+        return self.encoded(wip.xml_str_hash, lambda: wip.project, kind, width, height, **options)
+
+    def image(self, xml_hash, project, kind, width, height, **options):
+        # RawImage, decoded from a cached encoding or freshly rendered
+        key = cache_key(xml_hash, kind, width, height, options)
+        data = self.lookup(key)
+        if data is not None:
+            return RawImage.from_encoded(data)
+        if callable(project):
+            project = project()
+        image, data = render_image(project, kind, width, height, **options)
+        self.store(key, data)
+        return image
+
+    def decoded(self, xml_hash, project, kind, width, height, **options):
+        key = cache_key(xml_hash, kind, width, height, options)
+        value = self.memory.get(key)
+        if value is None:
+            value = self.decode(self.image(xml_hash, project, kind, width, height, **options))
+            self.memory.put(key, value)
+        return value
+
+    def view_cached(self, wip, view):
+        # memory tier only, None on a miss
+        return self.memory.get(self.view_key(wip, view))
+
+    def view_key(self, wip, view):
+        kind, width, height, options = VIEWS[view]
+        return cache_key(wip.xml_str_hash, kind, width, height, options)
+
+    def put_view(self, wip, view, image):
+        # keeps a RawImage rendered elsewhere, for example by a RenderFarm
+        value = self.decode(image)
+        self.memory.put(self.view_key(wip, view), value)
+        return value
+
+    def view(self, wip, view):
+        kind, width, height, options = VIEWS[view]
+        return self.decoded(wip.xml_str_hash, lambda: wip.project, kind, width, height, **options)
+
+    def prepare(self, wip):
+        # warms the encoded tiers, for use as the ingest prepare hook
+        for view in VIEWS:
+            self.view_encoded(wip, view)
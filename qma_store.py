@@ -0,0 +1,157 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import json
+import threading
+import time
+import redis
+
+class QueueStore(object):
+    # queue positions and settings kept in redis:
+    #   <prefix>queue     sorted set, xml hash scored by queue position
+    #   <prefix>settings  hash, setting index -> json
+    #   <prefix>version   counter, incremented by every flush
+    #
+    # writes are buffered and coalesced, a background thread sends
+    # them in one pipeline every flush_interval seconds. several
+    # stations (and qma_cli) may share one queue: when the version
+    # moved on without them, positions are read again and passed to
+    # on_change(positions by xml hash), called on the flusher thread
+    def __init__(self, redis_conn, prefix="qma:", flush_interval=1.0, on_change=None):
+        self.redis_conn = redis_conn
+        self.queue_key = prefix + "queue"
+        self.settings_key = prefix + "settings"
+        self.version_key = prefix + "version"
+        # version this store last saw the queue at
+        self.version = 0
+        self.on_change = on_change
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # xml hash -> position, None to remove
+        self.pending_positions = {}
+        self.pending_settings = None
+        # positions as last read or written, a position equal to
+        # these is not written again, so a rebuild of the queue does
+        # not overwrite moves made elsewhere
+        self.known_positions = {}
+        # failed flushes in a row, later attempts back off up to a minute
+        self.failures = 0
+        self.retry_at = 0
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def set_position(self, xml_hash, position):
+        with self.lock:
+            if xml_hash not in self.pending_positions and self.known_positions.get(xml_hash) == position:
+                return
+            self.pending_positions[xml_hash] = position
+
+    def remove_position(self, xml_hash):
+        with self.lock:
+            self.pending_positions[xml_hash] = None
+
+    def set_settings(self, settings):
+        # settings is a list of dicts, see qma_core.setting_to_dict
+        with self.lock:
+            self.pending_settings = list(settings)
+
+    def flush(self):
+        if time.monotonic() < self.retry_at:
+            return
+        with self.lock:
+            positions, self.pending_positions = self.pending_positions, {}
+            settings, self.pending_settings = self.pending_settings, None
+        if not positions and settings is None:
+            return
+        pipe = self.redis_conn.pipeline(transaction=False)
+        scores = {xml_hash : position for xml_hash, position in positions.items() if position is not None}
+        removed = [xml_hash for xml_hash, position in positions.items() if position is None]
+        if scores:
+            pipe.zadd(self.queue_key, scores)
+        if removed:
+            pipe.zrem(self.queue_key, *removed)
+        if settings is not None:
+            # settings are replaced as a whole
+            pipe.delete(self.settings_key)
+            if settings:
+                pipe.hset(self.settings_key, mapping={str(index) : json.dumps(setting) for index, setting in enumerate(settings)})
+        pipe.incr(self.version_key)
+        try:
+            version = pipe.execute()[-1]
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as ex:
+            if not self.failures:
+                print("could not save queue state, retrying quietly: {}".format(ex))
+            self.failures += 1
+            self.retry_at = time.monotonic() + min(self.flush_interval * 2 ** self.failures, 60)
+            # put the writes back unless newer ones arrived meanwhile
+            with self.lock:
+                for xml_hash, position in positions.items():
+                    self.pending_positions.setdefault(xml_hash, position)
+                if self.pending_settings is None:
+                    self.pending_settings = settings
+            return
+        if self.failures:
+            print("saved queue state after {} failed attempts".format(self.failures))
+            self.failures = 0
+            self.retry_at = 0
+        with self.lock:
+            for xml_hash, position in positions.items():
+                if position is None:
+                    self.known_positions.pop(xml_hash, None)
+                else:
+                    self.known_positions[xml_hash] = position
+        # anyone else writing in between leaves the version behind for check()
+        if version == self.version + 1:
+            self.version = version
+
+    def restore(self):
+        # everything in one round trip, returns
+        # (positions by xml hash, list of settings)
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pipe.zrange(self.queue_key, 0, -1, withscores=True)
+        pipe.hgetall(self.settings_key)
+        pipe.get(self.version_key)
+        try:
+            queue, settings, version = pipe.execute()
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as ex:
+            print("could not restore queue state: {}".format(ex))
+            return {}, []
+        self.version = int(version or 0)
+        positions = {xml_hash : int(position) for xml_hash, position in queue}
+        with self.lock:
+            self.known_positions = dict(positions)
+        settings = [json.loads(settings[index]) for index in sorted(settings, key=int)]
+        return positions, settings
+
+    def check(self):
+        try:
+            version = int(self.redis_conn.get(self.version_key) or 0)
+            if version == self.version:
+                return
+            queue = self.redis_conn.zrange(self.queue_key, 0, -1, withscores=True)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            return
+        self.version = version
+        positions = {xml_hash : int(position) for xml_hash, position in queue}
+        with self.lock:
+            self.known_positions = dict(positions)
+        self.on_change(positions)
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+            if self.on_change is not None and not self.failures:
+                self.check()
+        self.flush()
+
+    def start(self):
+        self.flusher = threading.Thread(target=self.run, daemon=True)
+        self.flusher.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join(timeout=5)
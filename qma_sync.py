@@ -0,0 +1,249 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import concurrent.futures
+import fnmatch
+import hashlib
+import redis
+from qma_metrics import metrics
+
+# sha1 of each key's value computed server side, so unchanged
+# projects can be skipped without transferring their xml
+DIGEST_SCRIPT = """
+local digests = {}
+for i, key in ipairs(KEYS) do
+    local value = redis.pcall('GET', key)
+    if type(value) == 'string' then
+        digests[i] = redis.sha1hex(value)
+    else
+        digests[i] = false
+    end
+end
+return digests
+"""
+
+class ProjectSync(object):
+    # keeps a WipSet in step with the project:* keys in redis
+    #
+    # changes arrive through keyspace notifications (or an optional
+    # publish channel carrying key names) and only the keys that
+    # changed are fetched. reconcile() does a full scan and is
+    # meant to be called rarely, as a fallback for missed events.
+    # with several nodes, name prefixes the keys used as wipset
+    # sources so the same key on two nodes is two projects. on a
+    # cluster node the keys of a batch span hash slots, so they are
+    # read with one command per key in a pipeline
+    def __init__(self, redis_conn, wipset, pattern="project:*", channel=None, batch_size=500, name=None, cluster=False):
+        self.redis_conn = redis_conn
+        self.cluster = cluster
+        self.wipset = wipset
+        self.source_prefix = name + "/" if name else ""
+        self.pattern = pattern
+        self.channel = channel
+        self.batch_size = batch_size
+        # key -> sha1 of the xml last loaded from it
+        self.digests = {}
+        self.digest_script = redis_conn.register_script(DIGEST_SCRIPT)
+        self.pubsub = None
+        # False when changes can only be found by reconciling
+        self.notifying = True
+        self.keyspace_prefix = "__keyspace@{}__:".format(redis_conn.connection_pool.connection_kwargs.get("db", 0))
+        self.needs_reconcile = True
+
+    def enable_notifications(self):
+        # merge K$gx into the existing flags instead of replacing them.
+        # returns False if they could not be confirmed, for example
+        # when the server disallows CONFIG
+        try:
+            flags = self.redis_conn.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+            wanted = "" if "A" in flags else "$gx"
+            missing = "".join(flag for flag in "K" + wanted if flag not in flags)
+            if missing:
+                self.redis_conn.config_set("notify-keyspace-events", flags + missing)
+        except redis.exceptions.ResponseError as ex:
+            print("keyspace notifications unavailable, polling instead: {}".format(ex))
+            return False
+        return True
+
+    def subscribe(self):
+        # a publish channel announces changes even without keyspace events
+        self.notifying = self.enable_notifications() or bool(self.channel)
+        self.pubsub = self.redis_conn.pubsub()
+        self.pubsub.psubscribe(self.keyspace_prefix + self.pattern)
+        if self.channel:
+            self.pubsub.subscribe(self.channel)
+
+    def unsubscribe(self):
+        if self.pubsub is not None:
+            try:
+                self.pubsub.close()
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+                pass
+            self.pubsub = None
+
+    def pending_keys(self, timeout=0):
+        # blocks up to timeout for the first message only
+        keys = set()
+        while True:
+            message = self.pubsub.get_message(timeout=timeout)
+            timeout = 0
+            if message is None:
+                break
+            if message["type"] == "pmessage":
+                keys.add(message["channel"][len(self.keyspace_prefix):])
+            elif message["type"] == "message":
+                keys.add(message["data"])
+        return keys
+
+    def poll(self, timeout=0):
+        # returns True if the wipset changed
+        try:
+            if self.pubsub is None:
+                self.subscribe()
+                # anything written while unsubscribed was missed
+                self.needs_reconcile = True
+            if self.needs_reconcile:
+                return self.reconcile()
+            return self.apply(self.pending_keys(timeout))
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            self.unsubscribe()
+            return False
+
+    @metrics.timed("sync_apply")
+    def apply(self, keys):
+        # notified keys are known to have changed, fetch without digests
+        changed = False
+        keys = list(keys)
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            changed |= self.load(batch, self.values(batch))
+        return changed
+
+    def values(self, keys):
+        if not self.cluster:
+            return self.redis_conn.mget(keys)
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        return pipe.execute()
+
+    def value_digests(self, keys):
+        if not self.cluster:
+            return self.digest_script(keys=keys)
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for key in keys:
+            self.digest_script(keys=[key], client=pipe)
+        return [digests[0] for digests in pipe.execute()]
+
+    def load(self, keys, values):
+        changed = False
+        metrics.count("sync_keys_fetched", len(keys))
+        for key, xml in zip(keys, values):
+            if xml is None:
+                self.digests.pop(key, None)
+                changed |= self.wipset.remove(self.source_prefix + key)
+            else:
+                self.digests[key] = hashlib.sha1(xml.encode()).hexdigest()
+                changed |= self.wipset.add(xml, source=self.source_prefix + key)
+        return changed
+
+    def fetch_changed(self, keys):
+        try:
+            digests = self.value_digests(keys)
+        except redis.exceptions.ResponseError:
+            # no scripting, fall back to fetching everything
+            return self.load(keys, self.values(keys))
+        stale = [key for key, digest in zip(keys, digests) if digest is None or self.digests.get(key) != digest]
+        if not stale:
+            return False
+        return self.load(stale, self.values(stale))
+
+    @metrics.timed("sync_reconcile")
+    def reconcile(self):
+        changed = False
+        seen = set()
+        batch = []
+        for key in self.redis_conn.scan_iter(self.pattern, count=self.batch_size):
+            if key in seen:
+                continue
+            seen.add(key)
+            batch.append(key)
+            if len(batch) >= self.batch_size:
+                changed |= self.fetch_changed(batch)
+                batch = []
+        if batch:
+            changed |= self.fetch_changed(batch)
+        prefix = self.source_prefix
+        for key in [source[len(prefix):] for source in list(self.wipset.sources) if source.startswith(prefix)]:
+            if fnmatch.fnmatchcase(key, self.pattern) and key not in seen:
+                self.digests.pop(key, None)
+                changed |= self.wipset.remove(prefix + key)
+        self.needs_reconcile = False
+        return changed
+
+class ShardedSync(object):
+    # ProjectSyncs for several nodes driven together, each call runs
+    # on every shard at once so the wipset they share must accept
+    # adds from several threads, as a WipFeed does
+    def __init__(self, syncs):
+        self.syncs = syncs
+        self.executor = None
+
+    def each(self, function):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.syncs))
+        futures = [self.executor.submit(function, sync) for sync in self.syncs]
+        changed = False
+        for future in futures:
+            try:
+                changed |= bool(future.result())
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+                pass
+        return changed
+
+    @property
+    def pubsub(self):
+        # None while any shard is unsubscribed, so the ingest worker backs off
+        for sync in self.syncs:
+            if sync.pubsub is None:
+                return None
+        return self.syncs[0].pubsub
+
+    @property
+    def notifying(self):
+        return all(sync.notifying for sync in self.syncs)
+
+    @property
+    def needs_reconcile(self):
+        return any(sync.needs_reconcile for sync in self.syncs)
+
+    @needs_reconcile.setter
+    def needs_reconcile(self, value):
+        for sync in self.syncs:
+            sync.needs_reconcile = value
+
+    def poll(self, timeout=0):
+        return self.each(lambda sync: sync.poll(timeout))
+
+    def reconcile(self):
+        return self.each(lambda sync: sync.reconcile())
+
+    def unsubscribe(self):
+        for sync in self.syncs:
+            sync.unsubscribe()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+def project_sync(shards, wipset, pattern="project:*", channel=None, batch_size=500, cluster=False):
+    # shards are (name, redis connection) as from RedisBackend.shards,
+    # None if there are none
+    if not shards:
+        return None
+    if len(shards) == 1:
+        return ProjectSync(shards[0][1], wipset, pattern=pattern, channel=channel, batch_size=batch_size, cluster=cluster)
+    return ShardedSync([ProjectSync(redis_conn, wipset, pattern=pattern, channel=channel, batch_size=batch_size, name=name, cluster=cluster)
+                        for name, redis_conn in shards])
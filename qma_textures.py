@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+from kivy.graphics.texture import Texture
+
+# RawImages uploaded to kivy textures with blit_buffer, main thread only
+
+def texture_from_raw(image):
+    colorfmt = image.mode.lower()
+    texture = Texture.create(size=(image.width, image.height), colorfmt=colorfmt)
+    texture.blit_buffer(image.pixels, colorfmt=colorfmt, bufferfmt="ubyte")
+    # kivy textures start at the bottom row
+    texture.flip_vertical()
+    return texture
+
+def texture_bytes(texture):
+    return texture.width * texture.height * 4
+
+class TextureAtlas(object):
+    # packs images of the same size and mode into shared page textures,
+    # rows of the queue draw from a few pages instead of a texture
+    # each. texture(image) returns a region of a page, release(region)
+    # frees its slot and a page without regions is dropped. images
+    # larger than a page, or every image with a page_size of 0, get
+    # a texture of their own. in_use() returns the textures widgets
+    # are showing, a region released while shown keeps its slot
+    # until it is no longer on screen
+    def __init__(self, page_size=1024, in_use=None):
+        self.page_size = page_size
+        self.in_use = in_use
+        # (width, height, mode) -> [(page, x, y)]
+        self.free = collections.defaultdict(list)
+        # region -> (shape, page, x, y)
+        self.slots = {}
+        # released regions that were still shown
+        self.retired = {}
+        # page -> regions in use
+        self.used = {}
+
+    @property
+    def bytes(self):
+        return len(self.used) * self.page_size * self.page_size * 4
+
+    def add_page(self, shape):
+        width, height, mode = shape
+        page = Texture.create(size=(self.page_size, self.page_size), colorfmt=mode.lower())
+        self.used[page] = 0
+        for y in range(0, self.page_size - height + 1, height):
+            for x in range(0, self.page_size - width + 1, width):
+                self.free[shape].append((page, x, y))
+
+    def texture(self, image):
+        if image.width > self.page_size or image.height > self.page_size:
+            return texture_from_raw(image)
+        shape = (image.width, image.height, image.mode)
+        if not self.free[shape]:
+            self.reclaim()
+        if not self.free[shape]:
+            self.add_page(shape)
+        page, x, y = self.free[shape].pop()
+        colorfmt = image.mode.lower()
+        page.blit_buffer(image.pixels, pos=(x, y), size=(image.width, image.height), colorfmt=colorfmt, bufferfmt="ubyte")
+        region = page.get_region(x, y, image.width, image.height)
+        region.flip_vertical()
+        self.slots[region] = (shape, page, x, y)
+        self.used[page] += 1
+        return region
+
+    def shown(self):
+        if self.in_use is None:
+            return set()
+        return set(texture for texture in self.in_use() if texture is not None)
+
+    def release(self, texture):
+        # textures not from this atlas are left to the garbage collector
+        try:
+            slot = self.slots.pop(texture)
+        except KeyError:
+            return
+        if texture in self.shown():
+            self.retired[texture] = slot
+            return
+        self.free_slot(*slot)
+
+    def reclaim(self):
+        shown = self.shown()
+        for texture in [texture for texture in self.retired if texture not in shown]:
+            self.free_slot(*self.retired.pop(texture))
+
+    def free_slot(self, shape, page, x, y):
+        self.used[page] -= 1
+        if self.used[page] == 0:
+            del self.used[page]
+            self.free[shape] = [slot for slot in self.free[shape] if slot[0] is not page]
+        else:
+            self.free[shape].append((page, x, y))
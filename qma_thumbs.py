@@ -0,0 +1,179 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import attr
+from qma_render import DiskTier
+from qma_metrics import metrics
+
+@attr.s
+class ThumbnailJob(object):
+    xml_hash = attr.ib(default="")
+    width = attr.ib(default=300)
+    height = attr.ib(default=300)
+    filename = attr.ib(default="")
+    process = attr.ib(default=None)
+    cancelled = attr.ib(default=False)
+    callback = attr.ib(default=None, repr=False)
+    errback = attr.ib(default=None, repr=False)
+    started = attr.ib(default=None, repr=False)
+
+def cache_key(xml_hash, width, height):
+    return "{}:fold:{}x{}".format(xml_hash, width, height)
+
+class ThumbnailJobs(object):
+    # runs fold thumbnail renders as child processes, each watched by
+    # a reaper thread that calls back as soon as the child exits.
+    # at most max_running children run at once, finished thumbnails
+    # are kept in cache_directory by xml hash and size.
+    # callbacks run on the reaper thread
+    def __init__(self, command="ma-ui-fold", directory=None, cache_directory=None, max_running=2, cache_bytes=None):
+        self.command = command
+        self.directory = directory or tempfile.gettempdir()
+        self.cache = DiskTier(cache_directory, max_bytes=cache_bytes) if cache_directory else None
+        self.max_running = max_running
+        self.jobs = {}
+        # (xml hash, width, height) -> (job, xml)
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def cached(self, xml_hash, width=300, height=300):
+        return self.cache is not None and os.path.exists(self.cache.path(cache_key(xml_hash, width, height)))
+
+    def request(self, xml_hash, xml, width=300, height=300, callback=None, errback=None, urgent=False):
+        # callback(job, jpeg bytes) or errback(job, message),
+        # without a callback the thumbnail is only rendered into the cache
+        job = ThumbnailJob(xml_hash=xml_hash,
+                           width=width,
+                           height=height,
+                           filename=os.path.join(self.directory, "thumb_{}.jpg".format(uuid.uuid4().hex)),
+                           callback=callback,
+                           errback=errback)
+        if self.cached(xml_hash, width, height):
+            if callback is not None:
+                data = self.cache.get(cache_key(xml_hash, width, height))
+                if data:
+                    callback(job, data)
+                    return job
+            else:
+                return job
+        if xml is None:
+            # the xml store no longer has the project
+            metrics.count("thumbnail_failures")
+            if errback is not None:
+                errback(job, "no xml")
+            return job
+        key = (xml_hash, width, height)
+        with self.lock:
+            existing = self.jobs.get(key) or self.pending.get(key, (None,))[0]
+            if existing is not None:
+                # a prefetch may already be running for what is now wanted
+                if callback is not None:
+                    existing.callback = callback
+                    existing.errback = errback
+                job = existing
+            else:
+                self.pending[key] = (job, xml)
+            if urgent and key in self.pending:
+                self.pending.move_to_end(key, last=False)
+        self.start_pending()
+        return job
+
+    def start_pending(self):
+        while True:
+            with self.lock:
+                if len(self.jobs) >= self.max_running or not self.pending:
+                    return
+                key, (job, xml) = self.pending.popitem(last=False)
+                # set size to 1x1 so kivy window does not popup,
+                # xml is passed over stdin instead of a temporary file
+                call = [self.command, "--size=1x1", "--",
+                        "--thumbnail-only",
+                        "--thumbnail-name", job.filename,
+                        "--thumbnail-width", str(job.width),
+                        "--thumbnail-height", str(job.height),
+                        "--xml-file", "/dev/stdin"]
+                try:
+                    job.process = subprocess.Popen(call, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    job.started = time.perf_counter()
+                except OSError as ex:
+                    metrics.count("thumbnail_failures")
+                    if job.errback is not None:
+                        job.errback(job, str(ex))
+                    continue
+                self.jobs[key] = job
+            threading.Thread(target=self.reap, args=(job, xml), daemon=True).start()
+
+    def reap(self, job, xml):
+        # the job always leaves self.jobs and the child is always
+        # waited on, whatever goes wrong, so its slot is not lost
+        try:
+            try:
+                _, err = job.process.communicate(xml.encode())
+            except OSError as ex:
+                err = str(ex).encode()
+            self.release(job)
+            metrics.observe("thumbnail_job", time.perf_counter() - job.started)
+            if job.cancelled:
+                metrics.count("thumbnail_cancelled")
+                return
+            try:
+                with open(job.filename, "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if job.process.returncode == 0 and data:
+                if self.cache is not None:
+                    self.cache.put(cache_key(job.xml_hash, job.width, job.height), data)
+                if job.callback is not None:
+                    job.callback(job, data)
+            else:
+                metrics.count("thumbnail_failures")
+                if job.errback is not None:
+                    message = err.decode(errors="replace").strip().splitlines()
+                    job.errback(job, "exit {}: {}".format(job.process.returncode, message[-1] if message else "no thumbnail written"))
+        finally:
+            if job.process.poll() is None:
+                job.process.kill()
+                job.process.wait()
+            self.release(job)
+            try:
+                os.remove(job.filename)
+            except OSError:
+                pass
+            self.start_pending()
+
+    def release(self, job):
+        key = (job.xml_hash, job.width, job.height)
+        with self.lock:
+            if self.jobs.get(key) is job:
+                del self.jobs[key]
+
+    def cancel(self, keep=()):
+        # drops pending and terminates running jobs whose xml hash is not in keep.
+        # cancelled jobs leave self.jobs at once, so asking again starts a new one
+        with self.lock:
+            for key in [key for key in self.pending if key[0] not in keep]:
+                del self.pending[key]
+            jobs = [job for job in self.jobs.values() if job.xml_hash not in keep]
+            for job in jobs:
+                del self.jobs[(job.xml_hash, job.width, job.height)]
+        for job in jobs:
+            job.cancelled = True
+            try:
+                job.process.terminate()
+            except OSError:
+                pass
+
+    def running(self):
+        with self.lock:
+            return list(self.jobs.values())
@@ -0,0 +1,104 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import os
+import threading
+import zlib
+import redis
+from qma_render import DiskTier
+
+# project xml text by sha224, kept out of the Wip objects and
+# fetched when needed, for example for a fold thumbnail.
+# every store has put(xml_hash, xml), get(xml_hash) and discard(xml_hash).
+# puts and discards are counted, an entry is only removed by the
+# discard matching its last put, so xml loaded again while an older
+# copy waits to be discarded is kept
+
+class MemoryXmlStore(object):
+    # zlib compressed in memory, the default when nothing is configured
+    def __init__(self):
+        self.entries = {}
+        self.refs = collections.Counter()
+        self.lock = threading.Lock()
+
+    def put(self, xml_hash, xml):
+        with self.lock:
+            self.refs[xml_hash] += 1
+            if xml_hash in self.entries:
+                return
+        data = zlib.compress(xml.encode())
+        with self.lock:
+            self.entries[xml_hash] = data
+
+    def get(self, xml_hash):
+        data = self.entries.get(xml_hash)
+        if data is None:
+            return None
+        return zlib.decompress(data).decode()
+
+    def discard(self, xml_hash):
+        with self.lock:
+            self.refs[xml_hash] -= 1
+            if self.refs[xml_hash] <= 0:
+                del self.refs[xml_hash]
+                self.entries.pop(xml_hash, None)
+
+class DiskXmlStore(object):
+    def __init__(self, directory):
+        self.disk = DiskTier(directory, extension=".xml.z")
+        self.refs = collections.Counter()
+        self.lock = threading.Lock()
+
+    def put(self, xml_hash, xml):
+        with self.lock:
+            self.refs[xml_hash] += 1
+        if not os.path.exists(self.disk.path(xml_hash)):
+            self.disk.put(xml_hash, zlib.compress(xml.encode()))
+
+    def get(self, xml_hash):
+        data = self.disk.get(xml_hash)
+        if data is None:
+            return None
+        return zlib.decompress(data).decode()
+
+    def discard(self, xml_hash):
+        with self.lock:
+            self.refs[xml_hash] -= 1
+            if self.refs[xml_hash] > 0:
+                return
+            del self.refs[xml_hash]
+        try:
+            os.remove(self.disk.path(xml_hash))
+        except OSError:
+            pass
+
+class RedisXmlStore(object):
+    # shared between qma-ui instances, expects a client without
+    # decode_responses. entries expire instead of being discarded
+    # since another instance may still hold the same project
+    def __init__(self, redis_conn, prefix="qma:xml:", ttl=7 * 24 * 60 * 60):
+        self.redis_conn = redis_conn
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def put(self, xml_hash, xml):
+        try:
+            self.redis_conn.set(self.prefix + xml_hash, zlib.compress(xml.encode()), ex=self.ttl)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            pass
+
+    def get(self, xml_hash):
+        try:
+            data = self.redis_conn.get(self.prefix + xml_hash)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            return None
+        if data is None:
+            return None
+        return zlib.decompress(data).decode()
+
+    def discard(self, xml_hash):
+        pass